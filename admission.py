@@ -0,0 +1,170 @@
+"""Controlo de admissão e rate limiting do chat.
+
+- `TokenBucket` / `ClientRateLimiter`: limite por cliente (429 + Retry-After).
+- `AdmissionController`: nº máximo de streams LLM em simultâneo com uma
+  fila de espera limitada; quando está cheia (ou a espera expira) rejeita
+  logo com 503 + Retry-After em vez de deixar o pedido pendurado.
+
+A capacidade do chat é uma fração do orçamento total de LLM da chave
+OpenAI; o resto fica reservado para os jobs de background (pipelines).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from shared_cache import worker_count
+
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_BACKGROUND_RESERVE = float(os.getenv("LLM_BACKGROUND_RESERVE", "0.25"))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "32"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "5"))
+CHAT_RATE_PER_MIN = float(os.getenv("CHAT_RATE_PER_MIN", "12"))
+CHAT_BURST = int(os.getenv("CHAT_BURST", "4"))
+
+# livesum: em modo multi-worker (PROMETHEUS_MULTIPROC_DIR) soma os workers vivos
+ADMISSION_ACTIVE = Gauge(
+    "chat_llm_streams_active", "Streams LLM do chat em curso", multiprocess_mode="livesum"
+)
+ADMISSION_QUEUE = Gauge(
+    "chat_admission_queue_depth", "Pedidos de chat à espera de vaga", multiprocess_mode="livesum"
+)
+ADMISSION_REJECTED = Counter(
+    "chat_rejections_total", "Pedidos de chat rejeitados", ["reason"]
+)
+
+
+def chat_capacity(
+    total: int = LLM_MAX_CONCURRENCY,
+    reserve: float = LLM_BACKGROUND_RESERVE,
+    workers: Optional[int] = None,
+) -> int:
+    """Vagas LLM deste worker depois de reservar a quota dos jobs de background.
+
+    O orçamento é da chave OpenAI (de todo o host), por isso divide-se pelos workers.
+    """
+
+    workers = workers or worker_count()
+    return max(1, math.floor(total * (1.0 - reserve) / workers))
+
+
+class Overloaded(Exception):
+    """Pedido rejeitado; `retry_after` em segundos."""
+
+    def __init__(self, reason: str, retry_after: int) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, burst: int) -> None:
+        self.rate = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> Tuple[bool, float]:
+        """Consome 1 token → (ok, segundos até haver token)."""
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True, 0.0
+        return False, (1.0 - self.tokens) / self.rate
+
+
+class ClientRateLimiter:
+    """Um token bucket por cliente; os clientes inativos mais antigos são descartados."""
+
+    def __init__(
+        self,
+        rate_per_min: float = CHAT_RATE_PER_MIN,
+        burst: int = CHAT_BURST,
+        max_clients: int = 10_000,
+    ) -> None:
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def check(self, client_key: Hashable) -> None:
+        bucket = self._buckets.pop(client_key, None) or TokenBucket(self.rate, self.burst)
+        self._buckets[client_key] = bucket
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+
+        ok, wait = bucket.take()
+        if not ok:
+            ADMISSION_REJECTED.labels(reason="rate_limited").inc()
+            raise Overloaded("rate_limited", max(1, math.ceil(wait)))
+
+
+class AdmissionController:
+    """Semáforo com fila de espera limitada e rejeição rápida."""
+
+    def __init__(
+        self,
+        max_concurrent: Optional[int] = None,
+        max_queue: int = CHAT_MAX_QUEUE,
+        queue_timeout: float = CHAT_QUEUE_TIMEOUT,
+    ) -> None:
+        self.max_concurrent = max_concurrent or chat_capacity()
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._sem = asyncio.Semaphore(self.max_concurrent)
+        self._avg_hold = 5.0  # duração média (s) de uma stream, média móvel
+
+    def retry_after(self) -> int:
+        backlog = (self.waiting + 1) / self.max_concurrent
+        return max(1, math.ceil(backlog * self._avg_hold))
+
+    async def acquire(self) -> float:
+        """Ocupa uma vaga; devolve o instante de entrada (para `release`)."""
+
+        if self._sem.locked() and self.waiting >= self.max_queue:
+            ADMISSION_REJECTED.labels(reason="queue_full").inc()
+            raise Overloaded("queue_full", self.retry_after())
+
+        self.waiting += 1
+        ADMISSION_QUEUE.set(self.waiting)
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            ADMISSION_REJECTED.labels(reason="queue_timeout").inc()
+            raise Overloaded("queue_timeout", self.retry_after())
+        finally:
+            self.waiting -= 1
+            ADMISSION_QUEUE.set(self.waiting)
+
+        self.active += 1
+        ADMISSION_ACTIVE.set(self.active)
+        return time.monotonic()
+
+    def release(self, started: Optional[float] = None) -> None:
+        if started is not None:
+            self._avg_hold = 0.8 * self._avg_hold + 0.2 * (time.monotonic() - started)
+        self.active -= 1
+        ADMISSION_ACTIVE.set(self.active)
+        self._sem.release()
+
+
+__all__ = [
+    "AdmissionController",
+    "ClientRateLimiter",
+    "Overloaded",
+    "TokenBucket",
+    "chat_capacity",
+]
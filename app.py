@@ -1,24 +1,174 @@
-import os, json, psycopg2, re
-from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import StreamingResponse
+import os, json, psycopg2, psycopg2.errors, re, asyncio, threading, time, logging, hashlib, ipaddress
+from contextlib import asynccontextmanager, contextmanager
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from fastapi import FastAPI, Query, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+from prometheus_client import CollectorRegistry, make_asgi_app, multiprocess
+from singleflight import SingleFlight, StreamFanout
+from admission import AdmissionController, ClientRateLimiter, Overloaded
+from shared_cache import cache_from_url, worker_count
+import eligibility_index
+import incentive_activity
+import reverse_match
 
 # --------------------------------
 # Boot
 # --------------------------------
+# Nada liga à BD/OpenAI no import: o pool e o cliente abrem-se na primeira
+# utilização (ou no warm-up em background do lifespan).
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not DATABASE_URL or not OPENAI_API_KEY:
-    raise RuntimeError("DATABASE_URL e OPENAI_API_KEY são obrigatórios")
+# com vários workers o total de ligações à BD divide-se entre eles
+DB_POOL_MAX_TOTAL = int(os.getenv("DB_POOL_MAX_TOTAL", "20"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX") or max(2, DB_POOL_MAX_TOTAL // worker_count()))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "3"))
+DB_CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", "5"))
+DB_POOL_WAIT = float(os.getenv("DB_POOL_WAIT", "5"))  # segundos à espera de uma ligação livre
+CACHE_TTL = 300                 # segundos de cache (contagens do corpus, incentivos, matches)
+ANSWER_TTL = 600                # respostas do chat por (pergunta, k, geração de matches)
+GENERATION_TTL = 5              # quanto tempo até ver uma geração de matches nova
+HOT_INCENTIVES = 50             # incentivos pré-carregados no warm-up
+GZIP_MIN_SIZE = 500             # bytes; respostas JSON mais pequenas seguem sem compressão
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_MS", "30")) / 1000
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "256"))
+STREAM_QUEUE_MAX = 64           # deltas que o leitor mais lento pode ficar atrás antes de pausar a OpenAI
+# proxies (IPs/CIDRs) cujo X-Forwarded-For é de confiança; vazio = ignora o header
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(p.strip(), strict=False)
+    for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()
+]
 
-conn = psycopg2.connect(DATABASE_URL)
-conn.autocommit = True
-client = OpenAI(api_key=OPENAI_API_KEY)
+log = logging.getLogger("public_incentives.app")
 
-app = FastAPI(title="Public Incentives API")
+class DatabaseUnavailable(RuntimeError):
+    pass
+
+class PoolExhausted(DatabaseUnavailable):
+    """Todas as ligações ocupadas durante DB_POOL_WAIT segundos."""
+
+_pool = None
+_pool_lock = threading.Lock()
+# o ThreadedConnectionPool não espera: com DB_POOL_MAX ligações em uso o
+# getconn() falha logo. O semáforo põe os pedidos em fila até haver vaga.
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_aclient = None
+state = {"db": False, "warm": False, "fts_index": False}
+
+def get_pool(retries: int = 1):
+    """Abre o pool de ligações na primeira utilização (com retry/backoff)."""
+    global _pool
+    if _pool is not None:
+        return _pool
+    if not DATABASE_URL:
+        raise DatabaseUnavailable("DATABASE_URL não definido")
+    with _pool_lock:
+        delay = 0.2
+        for attempt in range(retries):
+            if _pool is not None:
+                break
+            try:
+                pool = ThreadedConnectionPool(
+                    1, DB_POOL_MAX, DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT
+                )
+                ensure_app_schema(pool)
+                _pool = pool
+                state["db"] = True
+            except psycopg2.OperationalError as e:
+                if attempt + 1 == retries:
+                    raise DatabaseUnavailable(str(e)) from e
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+    return _pool
+
+def ensure_app_schema(pool):
+    """Migrações de que as queries da API dependem, antes do primeiro pedido.
+
+    Só corre DDL quando falta alguma coisa; se falhar (ex.: sem permissões)
+    fica registado e a API arranca na mesma.
+    """
+    pg = pool.getconn()
+    try:
+        with pg.cursor() as cur:
+            if not incentive_activity.schema_ready(cur):
+                incentive_activity.ensure_schema(cur)
+                incentive_activity.refresh(cur)
+                log.info("colunas de atividade dos incentivos criadas")
+            if not eligibility_index.schema_ready(cur):
+                eligibility_index.ensure_schema(cur)
+                eligibility_index.backfill(cur)
+                log.info("índice de elegibilidade criado")
+        pg.commit()
+    except psycopg2.Error as e:
+        pg.rollback()
+        log.warning("migração do schema incompleta: %s", e)
+    finally:
+        pool.putconn(pg, close=bool(pg.closed))
+
+@contextmanager
+def db_cursor():
+    pool = get_pool()
+    if not _pool_slots.acquire(timeout=DB_POOL_WAIT):
+        raise PoolExhausted(f"sem ligações livres após {DB_POOL_WAIT:g}s")
+    try:
+        pg = pool.getconn()
+        try:
+            pg.autocommit = True
+            with pg.cursor() as cur:
+                yield cur
+        finally:
+            # ligação partida (ex.: restart da BD) não volta ao pool
+            pool.putconn(pg, close=bool(pg.closed))
+    finally:
+        _pool_slots.release()
+
+def get_aclient() -> AsyncOpenAI:
+    global _aclient
+    if _aclient is None:
+        if not OPENAI_API_KEY:
+            raise RuntimeError("OPENAI_API_KEY não definido")
+        _aclient = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return _aclient
+
+# incentivos, matches e respostas: partilhados entre workers conforme CACHE_URL
+cache = cache_from_url()
+
+def cached_load(key: str, ttl: float, loader, *args):
+    """cache → BD; valores None (ex.: 404) não ficam em cache."""
+    value = cache.get(key)
+    if value is None:
+        value = loader(*args)
+        if value is not None:
+            cache.set(key, value, ttl)
+    return value
+
+async def warm_up():
+    """Abre o pool e aquece caches sem bloquear o arranque do worker."""
+    try:
+        await run_in_threadpool(get_pool, DB_CONNECT_RETRIES)
+        await run_in_threadpool(corpus_counts)
+        await run_in_threadpool(warm_hot_incentives)
+        await run_in_threadpool(check_fts)
+        state["warm"] = True
+    except Exception as e:
+        log.warning("warm-up incompleto: %s", e)
+
+@asynccontextmanager
+async def lifespan(app):
+    task = asyncio.create_task(warm_up())
+    yield
+    task.cancel()
+    if _pool is not None:
+        _pool.closeall()
+    if _aclient is not None:
+        await _aclient.close()
+
+app = FastAPI(title="Public Incentives API", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"],
@@ -27,12 +177,84 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class CompressionMiddleware:
+    """GZip nas respostas JSON; streams e /metrics passam diretas.
+
+    O gzip guarda os deltas do chat no buffer do compressor até haver bytes
+    suficientes, o que estragaria o streaming; o /metrics já comprime sozinho.
+    """
+
+    def __init__(self, app, minimum_size: int = GZIP_MIN_SIZE,
+                 skip_prefixes: tuple = ("/chat/stream", "/metrics")):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+        self.skip_prefixes = skip_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].startswith(self.skip_prefixes):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware)
+
+def metrics_app():
+    # multi-worker: prometheus_client agrega os ficheiros de PROMETHEUS_MULTIPROC_DIR
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return make_asgi_app(registry=registry)
+    return make_asgi_app()
+
+app.mount("/metrics", metrics_app())
+
 CHAT_MODEL = "gpt-4o-mini"
 END_SENTINEL = "[[END_STREAM]]"
+STREAM_ERROR_TEXT = "\n\n(ocorreu um erro a gerar a resposta)"
+
+# pedidos idênticos em curso partilham a mesma execução (por worker)
+lookups = SingleFlight()
+chat_streams = StreamFanout(max_lag=STREAM_QUEUE_MAX)
+
+# admissão: rate limit por cliente + vagas LLM limitadas (resto fica para os pipelines)
+chat_limiter = ClientRateLimiter()
+chat_admission = AdmissionController()
 
 # --------------------------------
 # Utils
 # --------------------------------
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(addr in net for net in TRUSTED_PROXIES)
+
+def client_key(request: Request) -> str:
+    """IP do cliente para o rate limit.
+
+    O X-Forwarded-For só conta se o pedido vier de um proxy de TRUSTED_PROXIES;
+    nesse caso usa-se o hop mais à direita que não é um proxy de confiança
+    (os da esquerda são escritos pelo próprio cliente).
+    """
+    host = request.client.host if request.client else "unknown"
+    if not is_trusted_proxy(host):
+        return host
+    hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+        host = hop
+    return host
+
+def overloaded_response(e: Overloaded) -> JSONResponse:
+    status = 429 if e.reason == "rate_limited" else 503
+    return JSONResponse(
+        {"detail": "Demasiados pedidos, tenta novamente mais tarde.", "reason": e.reason},
+        status_code=status,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
 def uget(usage_obj, *keys, default=0):
     """Lê contadores de tokens do objeto usage (SDK novo)."""
     if usage_obj is None:
@@ -43,36 +265,106 @@ def uget(usage_obj, *keys, default=0):
             return int(v)
     return default
 
+def corpus_counts():
+    """(total_incentives, total_companies), com cache de CACHE_TTL segundos."""
+    counts = cache.get("corpus_counts")
+    if counts is None:
+        with db_cursor() as cur:
+            cur.execute("SELECT (SELECT COUNT(*) FROM incentives), (SELECT COUNT(*) FROM companies)")
+            counts = [int(x) for x in cur.fetchone()]
+        cache.set("corpus_counts", counts, CACHE_TTL)
+    return counts
+
+def current_generation() -> int:
+    """Geração de matches publicada (0 se ainda não há gerações)."""
+    gen = cache.get("matches:generation")
+    if gen is None:
+        with db_cursor() as cur:
+            try:
+                cur.execute("""
+                  SELECT generation FROM match_runs
+                  WHERE published_at IS NOT NULL ORDER BY published_at DESC LIMIT 1
+                """)
+                row = cur.fetchone()
+            except psycopg2.errors.UndefinedTable:
+                row = None
+        gen = row[0] if row else 0
+        cache.set("matches:generation", gen, GENERATION_TTL)
+    return gen
+
+def warm_hot_incentives():
+    with db_cursor() as cur:
+        cur.execute("SELECT incentive_pk FROM incentives WHERE is_active ORDER BY incentive_pk DESC LIMIT %s",
+                    (HOT_INCENTIVES,))
+        ids = [r[0] for r in cur.fetchall()]
+    for iid in ids:
+        incentive = load_incentive(iid)
+        if incentive:
+            cache.set(f"incentive:{iid}", incentive, CACHE_TTL)
+
+def check_fts():
+    """Carrega o dicionário 'portuguese' e verifica se há índice GIN para o FTS."""
+    with db_cursor() as cur:
+        cur.execute("SELECT plainto_tsquery('portuguese', 'incentivo')")
+        cur.execute("""
+          SELECT EXISTS (SELECT 1 FROM pg_indexes
+                         WHERE tablename = 'incentives' AND indexdef ILIKE '%to_tsvector%')
+        """)
+        state["fts_index"] = bool(cur.fetchone()[0])
+
+@app.exception_handler(DatabaseUnavailable)
+@app.exception_handler(PoolError)
+@app.exception_handler(psycopg2.OperationalError)
+async def database_unavailable(request: Request, exc: Exception):
+    return JSONResponse(
+        {"detail": "Base de dados indisponível"}, status_code=503, headers={"Retry-After": "2"}
+    )
+
 # --------------------------------
 # Endpoints
 # --------------------------------
+@app.get("/health/live")
+def health_live():
+    """Liveness: o processo responde (não toca na BD)."""
+    return {"ok": True}
+
+@app.get("/health/ready")
+def health_ready():
+    """Readiness: pool aberto e BD a responder. O warm-up não é obrigatório."""
+    ok = False
+    try:
+        with db_cursor() as cur:
+            cur.execute("SELECT 1")
+            ok = cur.fetchone()[0] == 1
+    except (DatabaseUnavailable, psycopg2.Error):
+        pass
+    return JSONResponse({"ok": ok, **state}, status_code=200 if ok else 503)
+
 @app.get("/health")
 def health():
-    with conn.cursor() as cur:
-        cur.execute("SELECT 1")
-        ok = cur.fetchone()[0] == 1
-    return {"ok": ok}
+    return health_ready()
 
-@app.get("/incentives/{incentive_id}")
-def get_incentive(incentive_id: int):
-    with conn.cursor() as cur:
+def load_incentive(incentive_id: int):
+    with db_cursor() as cur:
         cur.execute("""
           SELECT incentive_pk, title, coalesce(ai_description,description,'') AS description,
                  coalesce(eligibility_criteria,'') AS eligibility_criteria,
-                 eligibility
+                 eligibility, is_active, valid_from, valid_to
           FROM incentives WHERE incentive_pk = %s
         """, (incentive_id,))
         row = cur.fetchone()
     if not row:
-        raise HTTPException(404, "Incentivo não encontrado")
+        return None
     return {
         "id": row[0], "title": row[1], "description": row[2],
-        "eligibility_criteria": row[3], "eligibility": row[4]
+        "eligibility_criteria": row[3], "eligibility": row[4],
+        "active": row[5],
+        "valid_from": row[6].isoformat() if row[6] else None,
+        "valid_to": row[7].isoformat() if row[7] else None,
     }
 
-@app.get("/matches/{incentive_id}")
-def get_matches(incentive_id: int):
-    with conn.cursor() as cur:
+def load_matches(incentive_id: int):
+    with db_cursor() as cur:
         cur.execute("""
           SELECT m.rank, m.score, m.explanation,
                  c.id, c.company_name, c.cae_primary_label
@@ -88,216 +380,485 @@ def get_matches(incentive_id: int):
         for r in rows
     ]
 
-@app.get("/chat/stream")
-def chat_stream(q: str = Query(..., min_length=1), k: int = 5):
+FIELDS_PATTERN = r"^\w+(,\w+)*$"
+
+# chaves de cada resposta, para validar `fields=` mesmo quando o resultado vem vazio
+INCENTIVE_FIELDS = ("id", "title", "description", "eligibility_criteria", "eligibility",
+                    "active", "valid_from", "valid_to")
+MATCH_FIELDS = ("rank", "score", "explanation", "company_id", "company_name", "cae")
+ELIGIBLE_FIELDS = ("id", "title", "active", "cae_restricted", "bonus_hits")
+COMPANY_INCENTIVE_FIELDS = ("rank", "id", "score", "rule_pass", "title")
+
+def parse_fields(fields: str, allowed) -> list:
+    """`fields=a,b` → ["a", "b"] (400 se algum não existir no endpoint); [] = todos."""
+    if not fields:
+        return []
+    wanted = fields.split(",")
+    unknown = [f for f in wanted if f not in allowed]
+    if unknown:
+        raise HTTPException(400, f"Campos desconhecidos: {', '.join(unknown)} (válidos: {', '.join(allowed)})")
+    return wanted
+
+def pick_fields(payload, wanted: list):
+    """Só as chaves pedidas (num objeto ou numa lista de objetos)."""
+    if not wanted or not payload:
+        return payload
+    if isinstance(payload, list):
+        return [{f: row.get(f) for f in wanted} for row in payload]
+    return {f: payload.get(f) for f in wanted}
+
+def load_matches_cached(incentive_id: int):
+    # a chave inclui a geração publicada: publicar/rollback invalida sozinho
+    key = f"matches:{current_generation()}:{incentive_id}"
+    return cached_load(key, CACHE_TTL, load_matches, incentive_id)
+
+@app.get("/incentives/{incentive_id}")
+async def get_incentive(incentive_id: int, fields: str = Query(None, pattern=FIELDS_PATTERN)):
+    wanted = parse_fields(fields, INCENTIVE_FIELDS)
+    key = f"incentive:{incentive_id}"
+    incentive = await lookups.do(
+        key, lambda: run_in_threadpool(cached_load, key, CACHE_TTL, load_incentive, incentive_id)
+    )
+    if not incentive:
+        raise HTTPException(404, "Incentivo não encontrado")
+    return pick_fields(incentive, wanted)
+
+@app.get("/matches/{incentive_id}")
+async def get_matches(incentive_id: int, fields: str = Query(None, pattern=FIELDS_PATTERN)):
+    """Top-5 do incentivo; `fields=company_id,score` omite p.ex. as explicações."""
+    wanted = parse_fields(fields, MATCH_FIELDS)
+    rows = await lookups.do(
+        ("matches", incentive_id), lambda: run_in_threadpool(load_matches_cached, incentive_id)
+    )
+    return pick_fields(rows, wanted)
+
+def load_eligible_for_cae(cae: str, limit: int):
+    with db_cursor() as cur:
+        return eligibility_index.incentives_for_cae(cur, cae, limit)
+
+def load_eligible_for_company(company_id: int, limit: int):
+    with db_cursor() as cur:
+        return eligibility_index.incentives_for_company(cur, company_id, limit)
+
+@app.get("/eligibility/incentives")
+async def get_eligible_for_cae(
+    cae: str = Query(..., min_length=1),
+    limit: int = Query(50, ge=1, le=500),
+    fields: str = Query(None, pattern=FIELDS_PATTERN),
+):
+    """Incentivos cujas regras aceitam o CAE (lookup no índice de elegibilidade)."""
+    wanted = parse_fields(fields, ELIGIBLE_FIELDS)
+    key = f"eligible:cae:{limit}:{' '.join(cae.lower().split())}"
+    rows = await lookups.do(
+        key, lambda: run_in_threadpool(cached_load, key, CACHE_TTL, load_eligible_for_cae, cae, limit)
+    )
+    return pick_fields(rows, wanted)
+
+@app.get("/companies/{company_id}/eligible-incentives")
+async def get_eligible_for_company(
+    company_id: int,
+    limit: int = Query(50, ge=1, le=500),
+    fields: str = Query(None, pattern=FIELDS_PATTERN),
+):
+    """Incentivos a que a empresa cumpre as regras (CAE + keywords obrigatórias)."""
+    wanted = parse_fields(fields, ELIGIBLE_FIELDS)
+    key = f"eligible:company:{limit}:{company_id}"
+    rows = await lookups.do(
+        key, lambda: run_in_threadpool(cached_load, key, CACHE_TTL, load_eligible_for_company, company_id, limit)
+    )
+    if rows is None:
+        raise HTTPException(404, "Empresa não encontrada")
+    return pick_fields(rows, wanted)
+
+def load_company_incentives(company_id: int, limit: int):
+    with db_cursor() as cur:
+        return reverse_match.incentives_for_company(cur, company_id, limit)
+
+@app.get("/companies/{company_id}/incentives")
+async def get_company_incentives(
+    company_id: int,
+    limit: int = Query(reverse_match.TOP_N, ge=1, le=50),
+    fields: str = Query(None, pattern=FIELDS_PATTERN),
+):
+    """Top incentivos da empresa (pré-calculados por reverse_match.py)."""
+    wanted = parse_fields(fields, COMPANY_INCENTIVE_FIELDS)
+    key = f"company_incentives:{limit}:{company_id}"
+    rows = await lookups.do(
+        key, lambda: run_in_threadpool(cached_load, key, CACHE_TTL, load_company_incentives, company_id, limit)
+    )
+    if rows is None:
+        raise HTTPException(404, "Empresa não encontrada ou ainda sem incentivos calculados")
+    return pick_fields(rows, wanted)
+
+def eligibility_lookup(cur, q: str):
+    """“empresa 123” / “CAE <designação>” → (assunto, incentivos elegíveis) ou None."""
+    try:
+        return _eligibility_lookup(cur, q)
+    except psycopg2.errors.UndefinedTable:
+        return None  # índice de elegibilidade por criar (sem permissões no arranque)
+
+def _eligibility_lookup(cur, q: str):
+    m = re.search(r"(?i)\bempresa\s*(\d+)", q)
+    if m:
+        # top pré-calculado (score completo); sem ele, só as regras do índice
+        try:
+            found = reverse_match.incentives_for_company(cur, int(m.group(1)))
+        except psycopg2.errors.UndefinedTable:
+            found = None  # reverse_match.py ainda não correu
+        if found is None:
+            found = eligibility_index.incentives_for_company(cur, int(m.group(1)), limit=500)
+        return (f"empresa {m.group(1)}", found) if found is not None else None
+    m = re.search(r"(?i)\bcae\s*[:=]?\s*[\"“']?([^\"”'?!.\n]+)", q)
+    # só CAEs que aparecem nalguma regra: evita tomar “cae mais comum” por um CAE
+    if m and eligibility_index.known_cae(cur, m.group(1)):
+        label = m.group(1).strip()
+        return f"CAE {label}", eligibility_index.incentives_for_cae(cur, label, limit=500)
+    return None
+
+def build_chat_prompt(q: str, k: int):
+    """Recolhe o contexto na BD e monta as mensagens (system, user) do chat.
+
+    Síncrono (psycopg2): o endpoint corre-o uma vez no threadpool.
+    """
     normalized_q = (q or "").lower()
     is_how_question = normalized_q.strip().startswith("como")
     ask_for_companies = any(w in normalized_q for w in ["empresa", "empresas", "companhia", "companhias"])
     MIN_MATCH_THRESHOLD = 1
 
-    def gen():
-        try:
-            # ---------- 1) Buscar contexto ----------
-            with conn.cursor() as cur:
-                # id explícito: “incentivo 3”
-                m = re.search(r"(?i)incentivo\s*(\d+)", q or "")
-                if m:
-                    cur.execute("""
-                      SELECT incentive_pk, title, coalesce(ai_description,description,'') AS d
-                      FROM incentives WHERE incentive_pk = %s
-                    """, (int(m.group(1)),))
-                    incs = cur.fetchall()
-                    match_count = len(incs)
-                else:
-                    # ILIKE livre
+    # ---------- 1) Buscar contexto ----------
+    with db_cursor() as cur:
+        # id explícito: “incentivo 3”
+        m = re.search(r"(?i)incentivo\s*(\d+)", q or "")
+        elig = None if m else eligibility_lookup(cur, q or "")
+        if m:
+            cur.execute("""
+              SELECT incentive_pk, title, coalesce(ai_description,description,'') AS d
+              FROM incentives WHERE incentive_pk = %s
+            """, (int(m.group(1)),))
+            incs = cur.fetchall()
+            match_count = len(incs)
+        elif elig:
+            # "que incentivos servem a empresa X / o CAE Y": resposta direta do índice
+            ids = [r["id"] for r in elig[1][:k]]
+            cur.execute("""
+              SELECT incentive_pk, title, coalesce(ai_description,description,'') AS d
+              FROM incentives WHERE incentive_pk = ANY(%s)
+            """, (ids,))
+            by_id = {r[0]: r for r in cur.fetchall()}
+            incs = [by_id[i] for i in ids if i in by_id]
+            match_count = len(elig[1])
+        else:
+            # ILIKE livre
+            cur.execute("""
+              SELECT incentive_pk, title, coalesce(ai_description,description,'') AS d
+              FROM incentives
+              WHERE title ILIKE %s OR coalesce(ai_description,description,'') ILIKE %s
+              ORDER BY is_active DESC, incentive_pk DESC
+              LIMIT %s
+            """, (f"%{q}%", f"%{q}%", k))
+            incs = cur.fetchall()
+            cur.execute("""
+              SELECT COUNT(*) FROM incentives
+              WHERE title ILIKE %s OR coalesce(ai_description,description,'') ILIKE %s
+            """, (f"%{q}%", f"%{q}%"))
+            match_count = int(cur.fetchone()[0])
+
+            # Fallback FTS
+            if match_count == 0:
+                terms = re.sub(r"[^\w\s]", " ", q).strip()
+                if terms:
                     cur.execute("""
-                      SELECT incentive_pk, title, coalesce(ai_description,description,'') AS d
-                      FROM incentives
-                      WHERE title ILIKE %s OR coalesce(ai_description,description,'') ILIKE %s
-                      ORDER BY incentive_pk DESC
+                      WITH src AS (
+                        SELECT incentive_pk,
+                               title,
+                               is_active,
+                               coalesce(ai_description,description,'') AS d,
+                               to_tsvector('portuguese',
+                                 coalesce(title,'') || ' ' ||
+                                 coalesce(description,'') || ' ' ||
+                                 coalesce(ai_description,'') || ' ' ||
+                                 coalesce(eligibility_criteria,'') || ' ' ||
+                                 coalesce(eligibility::text,'')
+                               ) AS vec
+                        FROM incentives
+                      )
+                      SELECT incentive_pk, title, d,
+                             ts_rank(vec, plainto_tsquery('portuguese', %s)) AS r
+                      FROM src
+                      WHERE vec @@ plainto_tsquery('portuguese', %s)
+                      ORDER BY is_active DESC, r DESC, incentive_pk DESC
                       LIMIT %s
-                    """, (f"%{q}%", f"%{q}%", k))
-                    incs = cur.fetchall()
+                    """, (terms, terms, k))
+                    incs = [(r[0], r[1], r[2]) for r in cur.fetchall()]
+
                     cur.execute("""
-                      SELECT COUNT(*) FROM incentives
-                      WHERE title ILIKE %s OR coalesce(ai_description,description,'') ILIKE %s
-                    """, (f"%{q}%", f"%{q}%"))
+                      WITH src AS (
+                        SELECT to_tsvector('portuguese',
+                                 coalesce(title,'') || ' ' ||
+                                 coalesce(description,'') || ' ' ||
+                                 coalesce(ai_description,'') || ' ' ||
+                                 coalesce(eligibility_criteria,'') || ' ' ||
+                                 coalesce(eligibility::text,'')
+                               ) AS vec
+                        FROM incentives
+                      )
+                      SELECT COUNT(*) FROM src
+                      WHERE vec @@ plainto_tsquery('portuguese', %s)
+                    """, (terms,))
                     match_count = int(cur.fetchone()[0])
 
-                    # Fallback FTS
-                    if match_count == 0:
-                        terms = re.sub(r"[^\w\s]", " ", q).strip()
-                        if terms:
-                            cur.execute("""
-                              WITH src AS (
-                                SELECT incentive_pk,
-                                       title,
-                                       coalesce(ai_description,description,'') AS d,
-                                       to_tsvector('portuguese',
-                                         coalesce(title,'') || ' ' ||
-                                         coalesce(description,'') || ' ' ||
-                                         coalesce(ai_description,'') || ' ' ||
-                                         coalesce(eligibility_criteria,'') || ' ' ||
-                                         coalesce(eligibility::text,'')
-                                       ) AS vec
-                                FROM incentives
-                              )
-                              SELECT incentive_pk, title, d,
-                                     ts_rank(vec, plainto_tsquery('portuguese', %s)) AS r
-                              FROM src
-                              WHERE vec @@ plainto_tsquery('portuguese', %s)
-                              ORDER BY r DESC, incentive_pk DESC
-                              LIMIT %s
-                            """, (terms, terms, k))
-                            incs = [(r[0], r[1], r[2]) for r in cur.fetchall()]
-
-                            cur.execute("""
-                              WITH src AS (
-                                SELECT to_tsvector('portuguese',
-                                         coalesce(title,'') || ' ' ||
-                                         coalesce(description,'') || ' ' ||
-                                         coalesce(ai_description,'') || ' ' ||
-                                         coalesce(eligibility_criteria,'') || ' ' ||
-                                         coalesce(eligibility::text,'')
-                                       ) AS vec
-                                FROM incentives
-                              )
-                              SELECT COUNT(*) FROM src
-                              WHERE vec @@ plainto_tsquery('portuguese', %s)
-                            """, (terms,))
-                            match_count = int(cur.fetchone()[0])
-
-                # Fallback absoluto
-                if not incs:
-                    cur.execute("""
-                      SELECT incentive_pk, title, coalesce(ai_description,description,'') AS d
-                      FROM incentives ORDER BY incentive_pk DESC LIMIT %s
-                    """, (k,))
-                    incs = cur.fetchall()
-                    if not m:
-                        match_count = 0
-
-                # Se pergunta “como …” e não pede empresas, reduz a 1 incentivo
-                if is_how_question and not ask_for_companies and not m:
-                    incs = incs[:1]
-                    if match_count:
-                        match_count = min(match_count, len(incs))
-
-                if match_count < MIN_MATCH_THRESHOLD:
-                    incs = []
-                    match_count = 0
-
-                cur.execute("SELECT COUNT(*) FROM incentives")
-                total_incentives = int(cur.fetchone()[0])
-                cur.execute("SELECT COUNT(*) FROM companies")
-                total_companies = int(cur.fetchone()[0])
-
-            context_items = []
-            with conn.cursor() as cur:
-                for iid, title, desc in incs:
-                    matches = []
-                    if not (is_how_question and not ask_for_companies):
-                        cur.execute("""
-                          SELECT m.rank, c.company_name, c.cae_primary_label, coalesce(m.explanation,'')
-                          FROM matches m JOIN companies c ON c.id = m.company_id
-                          WHERE m.incentive_id = %s ORDER BY m.rank
-                        """, (iid,))
-                        top = cur.fetchall()
-                        matches = [{"rank": r, "company": n, "cae": cae, "why": exp}
-                                   for r, n, cae, exp in top]
-
-                    context_items.append({
-                        "incentive_id": iid,
-                        "title": title,
-                        "description": desc,
-                        "matches": matches,
-                    })
-
-            # ---------- 2) Prompt ----------
-            system = (
-                "Responde de forma concisa e factual. Identifica o tipo de pergunta:"
-                " • 'quantos/quantas' → responde com números e percentagens."
-                " • 'quais/qual' → lista incentivos/empresas em bullets."
-                " • 'como' → dá passos claros; só menciona empresas se a pergunta as referir."
-                " Nunca inventes dados fora do contexto."
-            )
-
-            formatting = (
-                "Formata em Markdown. Para cada incentivo:\n"
-                "### Incentivo {incentive_id} — {titulo}\n\n"
-                "**Resumo curto:** frase concisa.\n\n"
-                "**Pontos-chave**\n- ponto 1\n- ponto 2\n\n"
-            )
-            if not (is_how_question and not ask_for_companies):
-                formatting += "**Empresas elegíveis**\n1. **Nome** — CAE / justificativa\n\n"
-
-            if is_how_question:
-                formatting = (
-                    "Inicia com '### Passos recomendados' (lista numerada, ≥3 passos).\n"
-                ) + formatting
-
-            formatting += "Omitir secções vazias."
-
-            meta = {
-                "k": k,
-                "num_context_items": len(context_items),
-                "matching_count": match_count,
-                "total_incentives": total_incentives,
-                "total_companies": total_companies,
-            }
-
-            if not context_items:
-                context_json = "[]"
-                extra_note = (
-                    "Não foram encontrados incentivos diretamente relevantes; dá orientação genérica."
-                )
-            else:
-                context_json = json.dumps(context_items, ensure_ascii=False)[:7000]
-                extra_note = ""
-
-            user = (
-                f"Pergunta: {q}\n"
-                f"Meta: {json.dumps(meta, ensure_ascii=False)}\n"
-                f"{extra_note}\n"
-                f"Instruções de formatação: {formatting}\n"
-                f"Contexto JSON:\n{context_json}"
-            )
-
-            # ---------- 3) Streaming OpenAI ----------
-            prompt_tokens = completion_tokens = 0
-            with client.responses.stream(
-                model=CHAT_MODEL,
-                input=[
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": user},
-                ],
-                temperature=0.2,
-                max_output_tokens=400,
-            ) as stream:
-                have_text = False
-                for event in stream:
-                    if event.type == "response.output_text.delta":
-                        chunk = event.delta or ""
-                        if chunk:
-                            have_text = True
-                            yield chunk
-                    elif event.type == "response.completed":
-                        usage = getattr(event.response, "usage", None)
-                        prompt_tokens     = uget(usage, "prompt_tokens", "input_tokens", default=0)
-                        completion_tokens = uget(usage, "completion_tokens", "output_tokens", default=0)
-                        break
-                    elif event.type == "response.error":
-                        break
-                if not have_text:
-                    yield ""
-                yield END_SENTINEL
-
-            # (Opcional) logging de usage — aqui só imprimimos para debug
-            # print(f"usage: prompt={prompt_tokens}, completion={completion_tokens}")
-
-        except Exception as e:
-            # Em caso de erro, fecha a stream de forma limpa
-            yield "\n\n(ocorreu um erro a gerar a resposta)"
-            yield END_SENTINEL
+        # Fallback absoluto
+        if not incs:
+            cur.execute("""
+              SELECT incentive_pk, title, coalesce(ai_description,description,'') AS d
+              FROM incentives ORDER BY is_active DESC, incentive_pk DESC LIMIT %s
+            """, (k,))
+            incs = cur.fetchall()
+            if not m:
+                match_count = 0
+
+        # Se pergunta “como …” e não pede empresas, reduz a 1 incentivo
+        if is_how_question and not ask_for_companies and not m:
+            incs = incs[:1]
+            if match_count:
+                match_count = min(match_count, len(incs))
+
+        if match_count < MIN_MATCH_THRESHOLD:
+            incs = []
+            match_count = 0
+
+    total_incentives, total_companies = corpus_counts()
+
+    context_items = []
+    with db_cursor() as cur:
+        for iid, title, desc in incs:
+            matches = []
+            if not (is_how_question and not ask_for_companies) and not elig:
+                cur.execute("""
+                  SELECT m.rank, c.company_name, c.cae_primary_label, coalesce(m.explanation,'')
+                  FROM matches m JOIN companies c ON c.id = m.company_id
+                  WHERE m.incentive_id = %s ORDER BY m.rank
+                """, (iid,))
+                top = cur.fetchall()
+                matches = [{"rank": r, "company": n, "cae": cae, "why": exp}
+                           for r, n, cae, exp in top]
+
+            context_items.append({
+                "incentive_id": iid,
+                "title": title,
+                "description": desc,
+                "matches": matches,
+            })
+
+    # ---------- 2) Prompt ----------
+    system = (
+        "Responde de forma concisa e factual. Identifica o tipo de pergunta:"
+        " • 'quantos/quantas' → responde com números e percentagens."
+        " • 'quais/qual' → lista incentivos/empresas em bullets."
+        " • 'como' → dá passos claros; só menciona empresas se a pergunta as referir."
+        " Nunca inventes dados fora do contexto."
+    )
+
+    formatting = (
+        "Formata em Markdown. Para cada incentivo:\n"
+        "### Incentivo {incentive_id} — {titulo}\n\n"
+        "**Resumo curto:** frase concisa.\n\n"
+        "**Pontos-chave**\n- ponto 1\n- ponto 2\n\n"
+    )
+    if not (is_how_question and not ask_for_companies):
+        formatting += "**Empresas elegíveis**\n1. **Nome** — CAE / justificativa\n\n"
+
+    if is_how_question:
+        formatting = (
+            "Inicia com '### Passos recomendados' (lista numerada, ≥3 passos).\n"
+        ) + formatting
+
+    formatting += "Omitir secções vazias."
+
+    meta = {
+        "k": k,
+        "num_context_items": len(context_items),
+        "matching_count": match_count,
+        "total_incentives": total_incentives,
+        "total_companies": total_companies,
+    }
+    if elig:
+        meta["elegiveis_para"] = elig[0]
+
+    if not context_items:
+        context_json = "[]"
+        extra_note = (
+            "Não foram encontrados incentivos diretamente relevantes; dá orientação genérica."
+        )
+    else:
+        context_json = json.dumps(context_items, ensure_ascii=False)[:7000]
+        extra_note = ""
+
+    user = (
+        f"Pergunta: {q}\n"
+        f"Meta: {json.dumps(meta, ensure_ascii=False)}\n"
+        f"{extra_note}\n"
+        f"Instruções de formatação: {formatting}\n"
+        f"Contexto JSON:\n{context_json}"
+    )
+
+    return system, user
+
+def chat_answer_key(q: str, k: int) -> str:
+    digest = hashlib.sha256(f"{k}\x1f{q}".encode("utf-8")).hexdigest()[:32]
+    return f"answer:{current_generation()}:{digest}"
+
+async def answer_stream(q: str, k: int, answer_key: str = None):
+    """Contexto (BD, no threadpool) + stream da OpenAI → deltas de texto.
+
+    Respostas completas ficam na cache partilhada sob `answer_key`.
+    """
+    prompt_tokens = completion_tokens = 0
+    parts, completed = [], False
+    try:
+        system, user = await run_in_threadpool(build_chat_prompt, q, k)
+        async with get_aclient().responses.stream(
+            model=CHAT_MODEL,
+            input=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": user},
+            ],
+            temperature=0.2,
+            max_output_tokens=400,
+        ) as stream:
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    chunk = event.delta or ""
+                    if chunk:
+                        parts.append(chunk)
+                        yield chunk
+                elif event.type == "response.completed":
+                    completed = True
+                    usage = getattr(event.response, "usage", None)
+                    prompt_tokens     = uget(usage, "prompt_tokens", "input_tokens", default=0)
+                    completion_tokens = uget(usage, "completion_tokens", "output_tokens", default=0)
+                    break
+                elif event.type == "response.error":
+                    break
+
+        # (Opcional) logging de usage — aqui só imprimimos para debug
+        # print(f"usage: prompt={prompt_tokens}, completion={completion_tokens}")
+        if completed and parts and answer_key:
+            await run_in_threadpool(cache.set, answer_key, "".join(parts), ANSWER_TTL)
+    except Exception:
+        # Em caso de erro, fecha a stream de forma limpa
+        yield STREAM_ERROR_TEXT
+
+async def coalesce(chunks, interval: float = STREAM_FLUSH_INTERVAL, max_bytes: int = STREAM_FLUSH_BYTES):
+    """Junta deltas pequenos: emite quando passam `interval` s desde o último
+    envio ou quando há `max_bytes` acumulados (menos writes/pacotes por stream).
+
+    O primeiro delta sai logo, para não atrasar o time-to-first-token.
+    """
+    loop = asyncio.get_running_loop()
+    it = chunks.__aiter__()
+    buf, size = [], 0
+    last_flush = float("-inf")
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            timeout = max(0.0, last_flush + interval - loop.time()) if buf else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+                buf.append(chunk)
+                size += len(chunk.encode("utf-8"))
+                if size < max_bytes and loop.time() - last_flush < interval:
+                    continue
+            # tempo esgotado (com o próximo delta ainda pendente) ou buffer cheio
+            yield "".join(buf)
+            buf, size = [], 0
+            last_flush = loop.time()
+        if buf:
+            yield "".join(buf)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+
+def sse_event(data: str, event: str = None) -> str:
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+@app.get("/chat/stream")
+async def chat_stream(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    k: int = 5,
+    format: str = Query("text", pattern="^(text|sse)$"),
+):
+    use_sse = format == "sse" or "text/event-stream" in request.headers.get("accept", "")
+
+    def encode(chunk: str) -> str:
+        return sse_event(chunk) if use_sse else chunk
+
+    def encode_end() -> str:
+        return sse_event(END_SENTINEL, event="end") if use_sse else END_SENTINEL
+
+    try:
+        chat_limiter.check(client_key(request))
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    # Resposta já gerada (por qualquer worker) para a mesma pergunta e geração de matches
+    try:
+        answer_key = await run_in_threadpool(chat_answer_key, q, k)
+        cached_answer = await run_in_threadpool(cache.get, answer_key)
+    except Exception:
+        answer_key = cached_answer = None
+    if cached_answer is not None:
+        async def replay():
+            yield encode(cached_answer)
+            yield encode_end()
+        return StreamingResponse(
+            replay(), media_type="text/event-stream" if use_sse else "text/plain"
+        )
+
+    # Admissão: só quem abre uma stream nova ocupa vaga LLM.
+    key = (q, k)
+    make_stream = lambda: answer_stream(q, k, answer_key)
+    try:
+        if key not in chat_streams:
+            started = await chat_admission.acquire()
+            if not chat_streams.start(
+                key, make_stream, on_done=lambda: chat_admission.release(started)
+            ):
+                chat_admission.release()  # alguém abriu a mesma stream enquanto esperávamos
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    # Pedidos idênticos em curso partilham a mesma stream upstream; quem
+    # chega a meio recebe primeiro os deltas já gerados.
+    upstream = chat_streams.subscribe(key, make_stream)
+
+    async def gen():
+        # O StreamingResponse fecha este gerador quando recebe http.disconnect;
+        # quando o último subscritor sai, a stream da OpenAI é cancelada.
+        flushes = coalesce(upstream)
+        try:
+            async for chunk in flushes:
+                yield encode(chunk)
+            yield encode_end()
+        finally:
+            await flushes.aclose()
+            await upstream.aclose()
 
+    if use_sse:
+        return StreamingResponse(
+            gen(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     return StreamingResponse(gen(), media_type="text/plain")
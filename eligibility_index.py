@@ -0,0 +1,242 @@
+"""Índice invertido das regras de elegibilidade dos incentivos.
+
+`incentives.eligibility` (JSON extraído por embed_incentives_and_eligibility.py)
+só era lido dentro de match.sql, reexpandido para cada candidato. Aqui os
+termos ficam normalizados numa tabela própria:
+
+    incentive_eligibility_terms (incentive_id, kind, term, term_norm)
+        kind ∈ cae | kw_required | kw_bonus
+
+com índice por (kind, term_norm), para responder por lookup a perguntas como
+"que incentivos aceitam o CAE X" ou "a que incentivos a empresa N é elegível".
+A normalização (minúsculas, espaços colapsados) é feita em SQL, igual dos dois
+lados (termos e texto da empresa) e igual à de match.sql / reverse_match.py,
+e as regras são as mesmas: sem CAEs listados o incentivo
+aceita qualquer CAE; todas as keywords obrigatórias têm de aparecer no texto
+da empresa (descrição + nome).
+
+A tabela é mantida por embed_incentives_and_eligibility.py; para reconstruir:
+
+    python eligibility_index.py reindex
+    python eligibility_index.py cae "Fabricação de mobiliário de madeira"
+    python eligibility_index.py company 138484
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+from typing import Iterable, List, Optional
+
+import psycopg2
+from dotenv import load_dotenv
+
+
+KINDS = {
+    "cae": "allowed_cae_labels",
+    "kw_required": "keywords_required",
+    "kw_bonus": "keywords_bonus",
+}
+
+SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS incentive_eligibility_terms (
+  incentive_id integer NOT NULL,
+  kind         text    NOT NULL,   -- cae | kw_required | kw_bonus
+  term         text    NOT NULL,
+  term_norm    text    NOT NULL,
+  PRIMARY KEY (incentive_id, kind, term_norm)
+);
+
+CREATE INDEX IF NOT EXISTS incentive_eligibility_terms_lookup_idx
+  ON incentive_eligibility_terms (kind, term_norm);
+
+-- nenhuma query o usava (os lookups vão à tabela de termos); só custava escritas
+DROP INDEX IF EXISTS incentives_eligibility_gin_idx;
+"""
+
+
+def norm_sql(expr: str) -> str:
+    """Expressão SQL de normalização de um termo (igual na indexação e na consulta)."""
+
+    return f"lower(regexp_replace(btrim({expr}), '\\s+', ' ', 'g'))"
+
+
+def ensure_schema(cur) -> None:
+    cur.execute(SCHEMA_DDL)
+
+
+def schema_ready(cur) -> bool:
+    cur.execute("SELECT to_regclass('incentive_eligibility_terms') IS NOT NULL")
+    return bool(cur.fetchone()[0])
+
+
+def sync(cur, incentive_ids: Optional[Iterable[int]] = None) -> int:
+    """Reconstrói os termos dos incentivos dados (todos se `incentive_ids` for None)."""
+
+    ids = None if incentive_ids is None else list(incentive_ids)
+    if ids == []:
+        return 0
+    where = "" if ids is None else "WHERE incentive_id = ANY(%(ids)s)"
+    cur.execute(f"DELETE FROM incentive_eligibility_terms {where}", {"ids": ids})
+
+    where = "" if ids is None else "AND i.incentive_pk = ANY(%(ids)s)"
+    kinds = ", ".join(f"('{kind}', '{field}')" for kind, field in KINDS.items())
+    cur.execute(
+        f"""
+        INSERT INTO incentive_eligibility_terms (incentive_id, kind, term, term_norm)
+        SELECT DISTINCT ON (i.incentive_pk, k.kind, {norm_sql("t.term")})
+               i.incentive_pk, k.kind, btrim(t.term), {norm_sql("t.term")}
+        FROM incentives i
+        CROSS JOIN (VALUES {kinds}) AS k (kind, field)
+        CROSS JOIN LATERAL jsonb_array_elements_text(
+          CASE WHEN jsonb_typeof(i.eligibility -> k.field) = 'array'
+               THEN i.eligibility -> k.field ELSE '[]'::jsonb END
+        ) AS t (term)
+        WHERE i.eligibility IS NOT NULL AND btrim(t.term) <> '' {where}
+        """,
+        {"ids": ids},
+    )
+    return cur.rowcount
+
+
+def prune_stale(cur) -> int:
+    """Apaga termos de incentivos sem elegibilidade (ex.: anulada pelo load_data.py)."""
+
+    cur.execute(
+        """
+        DELETE FROM incentive_eligibility_terms t
+        WHERE NOT EXISTS (SELECT 1 FROM incentives i
+                          WHERE i.incentive_pk = t.incentive_id AND i.eligibility IS NOT NULL)
+        """
+    )
+    return cur.rowcount
+
+
+def backfill(cur) -> int:
+    """Indexa incentivos com elegibilidade mas ainda sem termos (1.ª execução)."""
+
+    cur.execute(
+        """
+        SELECT i.incentive_pk FROM incentives i
+        WHERE i.eligibility IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM incentive_eligibility_terms t
+                          WHERE t.incentive_id = i.incentive_pk)
+        """
+    )
+    return sync(cur, [r[0] for r in cur.fetchall()])
+
+
+# Incentivos aceites por um CAE: com esse CAE na lista, ou sem restrição de CAE.
+# `%(text)s` é o texto da empresa (NULL = não verificar keywords).
+ELIGIBLE_SQL = f"""
+WITH cae_ok AS (
+  SELECT incentive_id FROM incentive_eligibility_terms
+  WHERE kind = 'cae' AND term_norm = {norm_sql("%(cae)s")}
+  UNION
+  SELECT i.incentive_pk FROM incentives i
+  WHERE NOT EXISTS (SELECT 1 FROM incentive_eligibility_terms t
+                    WHERE t.incentive_id = i.incentive_pk AND t.kind = 'cae')
+)
+SELECT i.incentive_pk, i.title, i.is_active,
+       EXISTS (SELECT 1 FROM incentive_eligibility_terms t
+               WHERE t.incentive_id = i.incentive_pk AND t.kind = 'cae') AS cae_restricted,
+       (SELECT count(*) FROM incentive_eligibility_terms t
+        WHERE t.incentive_id = i.incentive_pk AND t.kind = 'kw_bonus'
+          AND position(t.term_norm IN %(text)s) > 0) AS bonus_hits
+FROM cae_ok
+JOIN incentives i ON i.incentive_pk = cae_ok.incentive_id
+WHERE %(text)s IS NULL OR NOT EXISTS (
+  SELECT 1 FROM incentive_eligibility_terms t
+  WHERE t.incentive_id = i.incentive_pk AND t.kind = 'kw_required'
+    AND position(t.term_norm IN %(text)s) = 0
+)
+ORDER BY i.is_active DESC, cae_restricted DESC, bonus_hits DESC, i.incentive_pk DESC
+LIMIT %(limit)s
+"""
+
+
+def _rows(cur) -> List[dict]:
+    return [
+        {"id": r[0], "title": r[1], "active": r[2], "cae_restricted": r[3], "bonus_hits": int(r[4] or 0)}
+        for r in cur.fetchall()
+    ]
+
+
+def incentives_for_cae(cur, cae_label: str, limit: int = 50) -> List[dict]:
+    """Incentivos cujas regras aceitam este CAE (ativos e restritos a ele primeiro)."""
+
+    cur.execute(ELIGIBLE_SQL, {"cae": cae_label, "text": None, "limit": limit})
+    return _rows(cur)
+
+
+def known_cae(cur, cae_label: str) -> bool:
+    """O CAE aparece na lista de algum incentivo?"""
+
+    cur.execute(
+        f"SELECT 1 FROM incentive_eligibility_terms WHERE kind = 'cae' AND term_norm = {norm_sql('%s')} LIMIT 1",
+        (cae_label,),
+    )
+    return cur.fetchone() is not None
+
+
+def incentives_for_company(cur, company_id: int, limit: int = 50) -> Optional[List[dict]]:
+    """Incentivos a que a empresa cumpre as regras (CAE + keywords obrigatórias).
+
+    Devolve None se a empresa não existir.
+    """
+
+    text_expr = norm_sql("COALESCE(trade_description_native, '') || ' ' || COALESCE(company_name, '')")
+    cur.execute(
+        f"SELECT cae_primary_label, {text_expr} FROM companies WHERE id = %s",
+        (company_id,),
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    cae_label, company_text = row
+    cur.execute(ELIGIBLE_SQL, {"cae": cae_label or "", "text": company_text, "limit": limit})
+    return _rows(cur)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Índice de elegibilidade (CAE / keywords) dos incentivos.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("reindex", help="reconstrói o índice a partir de incentives.eligibility")
+    p_cae = sub.add_parser("cae", help="incentivos abertos a um CAE")
+    p_cae.add_argument("label")
+    p_company = sub.add_parser("company", help="incentivos a que uma empresa é elegível")
+    p_company.add_argument("company_id", type=int)
+    for p in (p_cae, p_company):
+        p.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise SystemExit("DATABASE_URL não definido")
+
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor()
+    ensure_schema(cur)
+
+    if args.cmd == "reindex":
+        print(f"✅ {sync(cur)} termos indexados.")
+    else:
+        if args.cmd == "cae":
+            rows = incentives_for_cae(cur, args.label, args.limit)
+        else:
+            rows = incentives_for_company(cur, args.company_id, args.limit)
+            if rows is None:
+                raise SystemExit(f"Empresa {args.company_id} não encontrada")
+        for r in rows:
+            scope = "CAE listado" if r["cae_restricted"] else "qualquer CAE"
+            print(f"{r['id']:>6}  {r['title']}  ({scope}, bónus={r['bonus_hits']})")
+        print(f"{len(rows)} incentivos.")
+
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
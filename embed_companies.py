@@ -1,42 +1,155 @@
-import os, time, math
+import os, time, math, argparse
+from collections import deque
 from dotenv import load_dotenv
 import psycopg2
+import tiktoken
 from psycopg2.extras import execute_values
-from openai import OpenAI, APIError, RateLimitError
+from openai import OpenAI, APIError, RateLimitError, BadRequestError
 from tqdm import tqdm
 from usage_logger import log_usage, extract_usage_fields
+import reverse_match
+import profiling
 
 load_dotenv()
 DB_URL = os.environ["DATABASE_URL"]
 OPENAI_KEY = os.environ["OPENAI_API_KEY"]
 
-BATCH_EMB  = 100      # quantos textos por chamada à API
-BATCH_DB   = 500      # commits por este nº de updates
-MAX_CHARS  = 2000     # corta textos longos (reduz tokens/custo)
 MODEL      = "text-embedding-3-small"
+BATCH_DB   = 500      # commits por este nº de updates
+
+# Limites por pedido da API de embeddings
+MAX_INPUT_TOKENS   = 8191      # por input; textos maiores são partidos em pedaços
+MAX_REQUEST_INPUTS = 2048      # inputs por pedido
+MAX_REQUEST_TOKENS = 300_000   # tokens por pedido (soma dos inputs)
+
+# Orçamento de tokens por pedido, ajustado em runtime (AIMD)
+START_REQUEST_TOKENS = 50_000
+MIN_REQUEST_TOKENS   = 4_000
+STEP_REQUEST_TOKENS  = 25_000  # aumento aditivo após um pedido rápido
+TARGET_LATENCY       = 8.0     # segundos; acima disto o orçamento encolhe
+BACKOFF_START        = 1.0     # espera após o 1.º 429; duplica a cada 429 seguido
+BACKOFF_MAX          = 32.0
+
+MAX_CHUNKS = 4        # pedaços por empresa (teto de custo para descrições enormes)
+
+try:
+    ENCODING = tiktoken.encoding_for_model(MODEL)
+except KeyError:
+    ENCODING = tiktoken.get_encoding("cl100k_base")
+
+
+class AdaptiveBudget:
+    """Tokens por pedido: sobe devagar enquanto a API responde depressa,
+    corta para metade com 429 / pedidos demasiado grandes / latência alta.
+
+    Também guarda o backoff: 429 seguidos (mesmo entre pedidos reenviados
+    mais pequenos) esperam cada vez mais; um pedido bem-sucedido repõe-no.
+    """
+
+    def __init__(self, start=START_REQUEST_TOKENS, low=MIN_REQUEST_TOKENS,
+                 high=MAX_REQUEST_TOKENS, target=TARGET_LATENCY):
+        self.tokens = start
+        self.low, self.high, self.target = low, high, target
+        self.backoff = BACKOFF_START
+
+    def on_success(self, latency):
+        self.backoff = BACKOFF_START
+        if latency <= self.target:
+            self.tokens = min(self.high, self.tokens + STEP_REQUEST_TOKENS)
+        else:
+            self.tokens = max(self.low, int(self.tokens * 0.7))
+
+    def shrink(self):
+        self.tokens = max(self.low, self.tokens // 2)
+
+    def on_throttle(self, retry_after=None):
+        """429: encolhe o orçamento e devolve quanto esperar antes de reenviar."""
+        self.shrink()
+        delay = max(self.backoff, retry_after or 0.0)
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+        return delay
+
+
+def company_text(desc, cae, name) -> str:
+    """Junta só as partes preenchidas ('' se a empresa não tem texto nenhum)."""
+    return " | ".join(p.strip() for p in (desc, cae, name) if p and p.strip())
 
-def clean_text(s: str) -> str:
-    s = (s or "").strip()
-    if not s:
-        return ""
-    # corta por caracteres (simples e suficiente); se quiseres, troca por contador de tokens
-    return s[:MAX_CHARS]
+def chunk_tokens(text: str):
+    """Tokeniza e parte em pedaços ≤ MAX_INPUT_TOKENS (no máximo MAX_CHUNKS)."""
+    tokens = ENCODING.encode(text)[: MAX_INPUT_TOKENS * MAX_CHUNKS]
+    return [tokens[i:i + MAX_INPUT_TOKENS] for i in range(0, len(tokens), MAX_INPUT_TOKENS)]
 
-def main():
-    client = OpenAI(api_key=OPENAI_KEY)
-    conn = psycopg2.connect(DB_URL)
+def combine(parts):
+    """Média dos embeddings dos pedaços (pesada pelo nº de tokens), renormalizada."""
+    if len(parts) == 1:
+        return parts[0][0]
+    dim = len(parts[0][0])
+    acc = [0.0] * dim
+    for vec, weight in parts:
+        for j in range(dim):
+            acc[j] += vec[j] * weight
+    norm = math.sqrt(sum(x * x for x in acc)) or 1.0
+    return [x / norm for x in acc]
+
+def take_request(queue, budget):
+    """Tira da fila os pedaços que cabem num pedido (pelo menos um)."""
+    batch, used = [], 0
+    while queue and len(batch) < MAX_REQUEST_INPUTS:
+        n = len(queue[0][2])
+        if batch and used + n > budget:
+            break
+        batch.append(queue.popleft())
+        used += n
+    return batch, used
+
+def retry_after_seconds(err):
+    """Retry-After (segundos) do 429, se a API o mandar."""
+    try:
+        return float(err.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def clear_zero_vectors(conn):
+    """Limpeza pontual: vetores zero de execuções antigas (textos vazios) poluem o índice ANN.
+
+    Varre a tabela toda, por isso só corre com --clean-zero-vectors; as
+    execuções atuais já não escrevem vetores zero.
+    """
+    with conn.cursor() as c:
+        c.execute("""
+            UPDATE companies SET embedding = NULL
+            WHERE embedding IS NOT NULL AND vector_norm(embedding) = 0
+        """)
+        print(f"🧹 {c.rowcount} vetores zero removidos.")
+    conn.commit()
+
+def main(conn=None, client=None, clean_zero_vectors=False):
+    """Embeddings das empresas em falta; devolve quantas atualizou.
+
+    `conn`/`client` permitem partilhar ligação e cliente OpenAI (ex.: pipeline.py).
+    """
+    client = client or OpenAI(api_key=OPENAI_KEY)
+    own_conn = conn is None
+    if own_conn:
+        conn = psycopg2.connect(DB_URL)
     conn.autocommit = False
+    with conn.cursor() as c:
+        reverse_match.ensure_schema(c)
+    conn.commit()
+    if clean_zero_vectors:
+        clear_zero_vectors(conn)
 
-    # server-side cursor (streaming do servidor)
+    # server-side cursor (streaming do servidor); empresas sem texto nenhum
+    # ficam sem embedding (e fora do matching) em vez de receberem um vetor zero
     cur = conn.cursor(name="companies_stream", withhold=True)
     cur.itersize = 2000
     cur.execute("""
-        SELECT id, 
-               coalesce(trade_description_native,'') || ' | ' ||
-               coalesce(cae_primary_label,'')        || ' | ' ||
-               coalesce(company_name,'')             AS txt
+        SELECT id, trade_description_native, cae_primary_label, company_name
         FROM companies
         WHERE embedding IS NULL
+          AND COALESCE(NULLIF(btrim(trade_description_native), ''),
+                       NULLIF(btrim(cae_primary_label), ''),
+                       NULLIF(btrim(company_name), '')) IS NOT NULL
     """)
 
     pending_updates = []
@@ -48,84 +161,98 @@ def main():
         nonlocal pending_updates, processed
         if not pending_updates:
             return
-        execute_values(
-            conn.cursor(),
-            """
-            UPDATE companies AS c
-            SET embedding = v.embedding
-            FROM (VALUES %s) AS v(id, embedding)
-            WHERE c.id = v.id
-            """,
-            pending_updates,
-            template="(%s, %s)"
-        )
-        conn.commit()
+        with profiling.span("db.write"):
+            wcur = conn.cursor()
+            execute_values(
+                wcur,
+                """
+                UPDATE companies AS c
+                SET embedding = v.embedding
+                FROM (VALUES %s) AS v(id, embedding)
+                WHERE c.id = v.id
+                """,
+                pending_updates,
+                template="(%s, %s)"
+            )
+            # embedding novo → top incentivos da empresa recalculados por reverse_match.py
+            reverse_match.invalidate(wcur, [cid for cid, _ in pending_updates])
+            conn.commit()
         processed += len(pending_updates)
         pbar.update(len(pending_updates))
         pending_updates = []
 
-    batch_texts = []
-    batch_ids = []
+    budget = AdaptiveBudget()
+    queue = deque()        # (company_id, nº de pedaços da empresa, tokens)
+    queued_tokens = 0
+    parts = {}             # company_id → [(embedding, nº tokens)] já recebidos
+    stats = {"requests": 0, "throttled": 0}
+
+    def send_one():
+        nonlocal queued_tokens
+        batch, used = take_request(queue, budget.tokens)
+        vecs = get_embeddings(client, [tokens for _, _, tokens in batch], MODEL, budget, stats)
+        if vecs is None:
+            # rejeitado (429 / demasiado grande): volta à fila, com orçamento já reduzido
+            queue.extendleft(reversed(batch))
+            return
+        queued_tokens -= used
+        for (cid, n_chunks, tokens), vec in zip(batch, vecs):
+            got = parts.setdefault(cid, [])
+            got.append((vec, len(tokens)))
+            if len(got) == n_chunks:
+                with profiling.span("combine"):
+                    vec = combine(parts.pop(cid))
+                if any(vec):  # nunca gravar um vetor zero (fica NULL e volta a ser tentado)
+                    pending_updates.append((cid, vec))
+        if len(pending_updates) >= BATCH_DB:
+            flush_updates()
 
     try:
         while True:
-            rows = cur.fetchmany(cur.itersize)
+            with profiling.span("db.fetch"):
+                rows = cur.fetchmany(cur.itersize)
             if not rows:
                 break
-            for company_id, raw_txt in rows:
-                txt = clean_text(raw_txt)
-                batch_ids.append(company_id)
-                batch_texts.append(txt if txt else None)  # None → tratamos já abaixo
-
-                # quando atingimos o tamanho do batch, chamamos a API
-                if len(batch_texts) >= BATCH_EMB:
-                    # gera embeddings para o lote
-                    embeddings = get_embeddings(client, batch_texts, MODEL)
-                    # agrega para update
-                    for cid, emb in zip(batch_ids, embeddings):
-                        pending_updates.append((cid, emb))
-                    batch_ids.clear()
-                    batch_texts.clear()
-
-                    # commit por lotes
-                    if len(pending_updates) >= BATCH_DB:
-                        flush_updates()
-
-        # último lote (se sobrar)
-        if batch_texts:
-            embeddings = get_embeddings(client, batch_texts, MODEL)
-            for cid, emb in zip(batch_ids, embeddings):
-                pending_updates.append((cid, emb))
-            batch_ids.clear()
-            batch_texts.clear()
+            for company_id, desc, cae, name in rows:
+                with profiling.span("tokenize"):
+                    chunks = chunk_tokens(company_text(desc, cae, name))
+                for tokens in chunks:
+                    queue.append((company_id, len(chunks), tokens))
+                    queued_tokens += len(tokens)
+
+                # pedidos cheios até ao orçamento atual: menos round-trips
+                while queued_tokens >= budget.tokens or len(queue) >= MAX_REQUEST_INPUTS:
+                    send_one()
+
+        while queue:
+            send_one()
 
         flush_updates()
         pbar.close()
-        print(f"✅ Concluído. Atualizadas {processed} linhas.")
+        print(f"✅ Concluído. Atualizadas {processed} linhas em {stats['requests']} pedidos "
+              f"({stats['throttled']} limitados; orçamento final {budget.tokens:,} tokens/pedido).")
+        return processed
 
     finally:
         try:
             cur.close()
         except Exception:
             pass
-        conn.close()
-
-def get_embeddings(client: OpenAI, texts, model):
-    """Chama a API em batch, com retry/backoff. Substitui vazios por vetor zero."""
-    # Substitui None/"" por vetor zero para manter dimensão
-    # (podes também optar por saltar update nesses casos)
-    if all(t is None or t.strip() == "" for t in texts):
-        return [[0.0]*1536 for _ in texts]
-
-    # onde o texto estiver vazio, mete placeholder, e depois devolve vetor zero
-    placeholders = [i for i,t in enumerate(texts) if t is None or t.strip()==""]
-    effective = [t if (t and t.strip()) else " " for t in texts]
+        if own_conn:
+            conn.close()
 
+def get_embeddings(client: OpenAI, inputs, model, budget: AdaptiveBudget, stats):
+    """Um pedido (inputs já tokenizados). Devolve None se for para reenviar mais pequeno."""
+    # sem retries do SDK: o orçamento tem de ver cada 429 e é ele que decide o backoff
+    client = client.with_options(max_retries=0)
     backoff = 1.0
     while True:
         try:
-            resp = client.embeddings.create(model=model, input=effective)
-            vecs = [d.embedding for d in resp.data]
+            t0 = time.perf_counter()
+            with profiling.span("api.embeddings"):
+                resp = client.embeddings.create(model=model, input=inputs)
+            budget.on_success(time.perf_counter() - t0)
+            stats["requests"] += 1
 
             usage = extract_usage_fields(resp)
             log_usage(
@@ -133,19 +260,29 @@ def get_embeddings(client: OpenAI, texts, model):
                 model=model,
                 prompt_tokens=usage["prompt_tokens"],
                 completion_tokens=usage["completion_tokens"],
-                metadata={"batch_size": len(effective)},
+                metadata={"batch_size": len(inputs), "budget_tokens": budget.tokens},
             )
-
-            for i in placeholders:
-                vecs[i] = [0.0]*1536
-            return vecs
-        except (RateLimitError, APIError) as e:
-            # backoff exponencial com limite
+            return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+        except RateLimitError as e:
+            # o backoff vive no orçamento: continua a crescer entre pedidos reenviados
+            stats["throttled"] += 1
+            time.sleep(budget.on_throttle(retry_after_seconds(e)))
+            if len(inputs) > 1:
+                return None
+        except BadRequestError:
+            # pedido acima do limite de tokens: parte ao meio; um input sozinho não tem remédio
+            if len(inputs) == 1 or budget.tokens <= budget.low:
+                raise
+            budget.shrink()
+            return None
+        except APIError:
+            # erro transitório do servidor → backoff exponencial com limite
             time.sleep(backoff)
             backoff = min(backoff * 2, 8.0)
-        except Exception as e:
-            # erro inesperado → re-lança (ou loga)
-            raise
 
 if __name__ == "__main__":
-    main()
+    profiling.init("embed_companies")  # --profile / PIPELINE_PROFILE
+    parser = argparse.ArgumentParser(description="Embeddings das empresas em falta.")
+    parser.add_argument("--clean-zero-vectors", action="store_true",
+                        help="limpeza pontual de vetores zero de execuções antigas (varre a tabela)")
+    main(clean_zero_vectors=parser.parse_args().clean_zero_vectors)
@@ -3,6 +3,9 @@ from dotenv import load_dotenv
 from tqdm import tqdm
 from openai import OpenAI
 from usage_logger import log_usage, extract_usage_fields
+import llm_cache
+import eligibility_index
+import profiling
 
 # -----------------------------------------------------------
 #  CONFIGURAÇÃO
@@ -13,92 +16,121 @@ PROMPT = """Extrai JSON estrito com campos:
 - keywords_required: string[]
 - keywords_bonus: string[]
 Apenas JSON válido na resposta."""
+ELIG_MODEL = "gpt-4o-mini"
 
 load_dotenv()
 
 DB_URL = os.getenv("DATABASE_URL")
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 
-client = OpenAI(api_key=OPENAI_KEY)
-conn = psycopg2.connect(DB_URL)
-cur = conn.cursor()
+def main(conn=None, client=None):
+    """Embeddings + elegibilidade dos incentivos em falta; devolve quantos processou.
 
-# -----------------------------------------------------------
-#  SELECIONA OS INCENTIVOS (usa a tua PK real)
-# -----------------------------------------------------------
-cur.execute("""
-  SELECT incentive_pk,
-         coalesce(title,'') || ' | ' ||
-         coalesce(ai_description, description, '') || ' | ' ||
-         coalesce(eligibility_criteria,'') AS txt,
-         coalesce(eligibility_criteria,'') AS crit
-  FROM incentives
-  WHERE embedding IS NULL OR eligibility IS NULL
-""")
-rows = cur.fetchall()
-print(f"{len(rows)} incentivos para processar.\n")
+    `conn`/`client` permitem partilhar ligação e cliente OpenAI (ex.: pipeline.py).
+    """
+    client = client or OpenAI(api_key=OPENAI_KEY)
+    own_conn = conn is None
+    if own_conn:
+        conn = psycopg2.connect(DB_URL)
+    cur = conn.cursor()
+    llm_cache.ensure_table(cur)
+    eligibility_index.ensure_schema(cur)
+    eligibility_index.backfill(cur)  # incentivos já extraídos antes de existir o índice
+    conn.commit()
 
-# -----------------------------------------------------------
-#  LOOP PRINCIPAL
-# -----------------------------------------------------------
-for rid, txt, crit in tqdm(rows, desc="Incentivos", unit="row"):
+    # -----------------------------------------------------------
+    #  SELECIONA OS INCENTIVOS (usa a tua PK real)
+    # -----------------------------------------------------------
+    profiling.execute(cur, """
+      SELECT incentive_pk,
+             coalesce(title,'') || ' | ' ||
+             coalesce(ai_description, description, '') || ' | ' ||
+             coalesce(eligibility_criteria,'') AS txt,
+             coalesce(eligibility_criteria,'') AS crit
+      FROM incentives
+      WHERE embedding IS NULL OR eligibility IS NULL
+    """, label="select incentives")
+    rows = cur.fetchall()
+    print(f"{len(rows)} incentivos para processar.\n")
 
-    # --- 1️⃣ Embedding
-    emb = [0.0]*1536
-    if txt.strip():
-        emb_resp = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=txt[:2000]
-        )
-        usage = extract_usage_fields(emb_resp)
-        log_usage(
-            source="embed_incentives",
-            model="text-embedding-3-small",
-            prompt_tokens=usage["prompt_tokens"],
-            completion_tokens=usage["completion_tokens"],
-            metadata={"incentive_id": rid, "phase": "embedding"}
-        )
-        emb = emb_resp.data[0].embedding
-        time.sleep(0.05)  # para não saturar a API
+    # -----------------------------------------------------------
+    #  LOOP PRINCIPAL
+    # -----------------------------------------------------------
+    for rid, txt, crit in tqdm(rows, desc="Incentivos", unit="row"):
 
-    # --- 2️⃣ Extrair JSON de elegibilidade
-    elig = None
-    if crit.strip():
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            response_format={"type": "json_object"},  # força JSON válido
-            temperature=0,
-            messages=[{
-                "role": "user",
-                "content": f"{PROMPT}\n\n---\n{crit[:2000]}\n---"
-            }]
-        )
-        usage = extract_usage_fields(resp)
-        log_usage(
-            source="embed_incentives",
-            model="gpt-4o-mini",
-            prompt_tokens=usage["prompt_tokens"],
-            completion_tokens=usage["completion_tokens"],
-            metadata={"incentive_id": rid, "phase": "eligibility"}
-        )
-        try:
-            elig = json.loads(resp.choices[0].message.content)
-        except Exception:
-            elig = {"allowed_cae_labels": [], "keywords_required": [], "keywords_bonus": []}
-        time.sleep(0.05)
+        # --- 1️⃣ Embedding
+        emb = [0.0]*1536
+        if txt.strip():
+            with profiling.span("api.embedding"):
+                emb_resp = client.embeddings.create(
+                    model="text-embedding-3-small",
+                    input=txt[:2000]
+                )
+            usage = extract_usage_fields(emb_resp)
+            log_usage(
+                source="embed_incentives",
+                model="text-embedding-3-small",
+                prompt_tokens=usage["prompt_tokens"],
+                completion_tokens=usage["completion_tokens"],
+                metadata={"incentive_id": rid, "phase": "embedding"}
+            )
+            emb = emb_resp.data[0].embedding
+            time.sleep(0.05)  # para não saturar a API
 
-    # --- 3️⃣ Atualizar base de dados
-    cur.execute("""
-        UPDATE incentives
-        SET embedding = %s,
-            eligibility = %s
-        WHERE incentive_pk = %s
-    """, (emb, json.dumps(elig) if elig else None, rid))
-    conn.commit()
+        # --- 2️⃣ Extrair JSON de elegibilidade
+        elig = None
+        if crit.strip():
+            # mesmo critério + prompt + modelo → reutiliza a extração anterior
+            cache_key = llm_cache.make_key("eligibility", ELIG_MODEL, PROMPT, crit[:2000])
+            with profiling.span("db.cache"):
+                elig = llm_cache.get(cur, cache_key)
+        if elig is None and crit.strip():
+            with profiling.span("api.eligibility"):
+                resp = client.chat.completions.create(
+                    model=ELIG_MODEL,
+                    response_format={"type": "json_object"},  # força JSON válido
+                    temperature=0,
+                    messages=[{
+                        "role": "user",
+                        "content": f"{PROMPT}\n\n---\n{crit[:2000]}\n---"
+                    }]
+                )
+            usage = extract_usage_fields(resp)
+            log_usage(
+                source="embed_incentives",
+                model=ELIG_MODEL,
+                prompt_tokens=usage["prompt_tokens"],
+                completion_tokens=usage["completion_tokens"],
+                metadata={"incentive_id": rid, "phase": "eligibility"}
+            )
+            try:
+                with profiling.span("json.parse"):
+                    elig = json.loads(resp.choices[0].message.content)
+                llm_cache.put(cur, cache_key, "eligibility", ELIG_MODEL, elig)
+            except Exception:
+                elig = {"allowed_cae_labels": [], "keywords_required": [], "keywords_bonus": []}
+            time.sleep(0.05)
 
-# -----------------------------------------------------------
-#  FINALIZAÇÃO
-# -----------------------------------------------------------
-cur.close()
-conn.close()
-print("\n✅ Processo concluído com sucesso!")
+        # --- 3️⃣ Atualizar base de dados
+        with profiling.span("db.write"):
+            cur.execute("""
+                UPDATE incentives
+                SET embedding = %s,
+                    eligibility = %s
+                WHERE incentive_pk = %s
+            """, (emb, json.dumps(elig) if elig else None, rid))
+            eligibility_index.sync(cur, [rid])
+            conn.commit()
+
+    # -----------------------------------------------------------
+    #  FINALIZAÇÃO
+    # -----------------------------------------------------------
+    cur.close()
+    if own_conn:
+        conn.close()
+    print("\n✅ Processo concluído com sucesso!")
+    return len(rows)
+
+if __name__ == "__main__":
+    profiling.init("embed_incentives")  # --profile / PIPELINE_PROFILE
+    main()
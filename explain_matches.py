@@ -1,9 +1,14 @@
 # explain_matches.py
-import os, json, time, psycopg2
+import os, json, time, argparse, psycopg2
+import tiktoken
 from dotenv import load_dotenv
 from psycopg2.extras import execute_values
 from openai import OpenAI, APIError, RateLimitError, APIConnectionError
 from usage_logger import log_usage, extract_usage_fields
+import llm_cache
+import matches_store
+import incentive_activity
+import profiling
 
 # ------------- CONFIG -------------
 TOP_K_FROM_MATCHES = 5          # quantos candidatos ler por incentivo (matches já tem 5)
@@ -12,6 +17,11 @@ MODEL = "gpt-4o-mini"
 SLEEP_BETWEEN = 0.05            # pausa curta entre incentivos
 RETRIES = 5
 
+# modo batch: vários incentivos por pedido (instruções enviadas uma só vez)
+BATCH_MAX_TOKENS = 6000         # teto de tokens de input por pedido
+BATCH_MAX_INCENTIVES = 10       # nunca mais do que isto por pedido (limita o output)
+BATCH_ROUNDS = 3                # quantas vezes re-enfileirar secções inválidas
+
 PROMPT_TEMPLATE = """Contexto do incentivo:
 Título: {title}
 Descrição: {desc}
@@ -37,23 +47,62 @@ Tarefa:
 }}
 """
 
+BATCH_PROMPT_HEADER = """Vais receber vários incentivos, cada um com o seu contexto e a sua tabela de candidatos.
+Usa SEMPRE o campo 'id' para referenciar a empresa.
+Campo RULE_PASS indica se cumpre as regras de elegibilidade (CAE + keywords obrigatórias).
+
+Tarefa (para CADA incentivo, de forma independente):
+1) Ordena objetivamente os candidatos privilegiando RULE_PASS = true. Se todos forem false, indica limitações e ordena mesmo assim.
+2) Para os 5 primeiros, devolve ID e uma frase curta (razão objetiva). Não repitas o nome.
+3) Responde apenas em JSON válido, com uma chave por ID de incentivo:
+{
+  "<incentive_id>": {
+    "top5": [
+      {"company_id": 123, "reason": "..." },
+      {"company_id": 456, "reason": "..." }
+    ]
+  }
+}
+
+Incentivos:
+"""
+
+BATCH_SECTION_TEMPLATE = """
+### Incentivo {iid}
+Título: {title}
+Descrição: {desc}
+Critérios (texto): {crit}
+Eligibility (JSON): {elig}
+Candidatos (top {k}):
+{table}
+"""
+
 # ------------- FUNÇÕES -------------
 def call_chat(client: OpenAI, prompt: str):
     """Faz chamada à API da OpenAI com retries automáticos"""
     for t in range(RETRIES):
         try:
-            return client.chat.completions.create(
-                model=MODEL,
-                response_format={"type": "json_object"},  # força JSON
-                temperature=0,
-                messages=[{"role": "user", "content": prompt}]
-            )
+            with profiling.span("api.chat"):
+                return client.chat.completions.create(
+                    model=MODEL,
+                    response_format={"type": "json_object"},  # força JSON
+                    temperature=0,
+                    messages=[{"role": "user", "content": prompt}]
+                )
         except (APIConnectionError, APIError, RateLimitError) as e:
             wait = 1.5 * (t + 1)
             print(f"⚠️  API erro {type(e).__name__}. Retry {t+1}/{RETRIES} em {wait:.1f}s...")
             time.sleep(wait)
     return None
 
+try:
+    _ENCODING = tiktoken.encoding_for_model(MODEL)
+except KeyError:
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text: str) -> int:
+    return len(_ENCODING.encode(text or ""))
+
 # ------------- PIPELINE -------------
 def format_company_row(idx: int, row: dict) -> str:
     desc_clean = (row["trade_description"] or '')[:180].replace('\n', ' ')
@@ -63,20 +112,8 @@ def format_company_row(idx: int, row: dict) -> str:
         f"CAE={row['cae']} | score={row['score']:.3f} | {desc_clean}"
     )
 
-def main():
-    load_dotenv()
-    db_url = os.getenv("DATABASE_URL")
-    api_key = os.getenv("OPENAI_API_KEY")
-
-    if not db_url or not api_key:
-        print("❌ Faltam DATABASE_URL ou OPENAI_API_KEY no .env")
-        return
-
-    client = OpenAI(api_key=api_key)
-    conn = psycopg2.connect(db_url)
-    cur = conn.cursor()
-
-    cur.execute("""
+def fetch_incentives(cur, include_inactive=False):
+    profiling.execute(cur, """
       SELECT i.incentive_pk,
              COALESCE(i.title,'') AS title,
              COALESCE(i.ai_description, i.description, '') AS desc,
@@ -84,67 +121,205 @@ def main():
              COALESCE(i.eligibility, '{}'::jsonb) AS elig
       FROM incentives i
       WHERE i.embedding IS NOT NULL
-    """)
-    incentives = cur.fetchall()
-    total = len(incentives)
-    print(f"🔎 Incentivos a processar: {total}")
+        AND (i.is_active OR %s)
+    """, (include_inactive,), label="fetch_incentives")
+    return cur.fetchall()
 
-    done = 0
+def fetch_candidates(cur, iid, generation):
+    """Lê os candidatos da geração em construção e devolve as linhas a enviar ao LLM."""
+    profiling.execute(cur, """
+      SELECT m.company_id,
+             m.score,
+             COALESCE(m.rule_pass::text, 'null') AS rule_pass_json,
+             c.company_name,
+             c.cae_primary_label,
+             c.trade_description_native
+      FROM match_results m
+      JOIN companies c ON c.id = m.company_id
+      WHERE m.generation = %s AND m.incentive_id = %s
+      ORDER BY m.rank
+      LIMIT %s
+    """, (generation, iid, TOP_K_FROM_MATCHES), label="fetch_candidates")
+    raw_rows = cur.fetchall()
+
+    rows = []
+    for row in raw_rows:
+        try:
+            rule_pass = json.loads(row[2]) if row[2] not in (None, 'null') else False
+            rule_pass = bool(rule_pass)
+        except Exception:
+            rule_pass = False
+        rows.append({
+            "company_id": row[0],
+            "score": float(row[1]),
+            "rule_pass": rule_pass,
+            "company_name": row[3],
+            "cae": row[4],
+            "trade_description": row[5],
+        })
+
+    passed = [r for r in rows if r["rule_pass"]]
+    return passed if passed else rows[:TOP_K_FROM_MATCHES]
+
+def prompt_fields(title, desc, crit, elig, rows_for_prompt) -> dict:
+    table_lines = [format_company_row(i + 1, r) for i, r in enumerate(rows_for_prompt)]
+    return {
+        "title": title[:MAX_TEXT],
+        "desc": (desc or "")[:MAX_TEXT],
+        "crit": (crit or "")[:MAX_TEXT],
+        "elig": json.dumps(elig, ensure_ascii=False),
+        "k": min(TOP_K_FROM_MATCHES, len(rows_for_prompt)),
+        "table": "\n".join(table_lines),
+    }
+
+def explain_cache_key(fields, rows_for_prompt) -> str:
+    """Chave da cache independente da ordem dos candidatos.
+
+    Este script reescreve `rank`, por isso a mesma lista de candidatos numa
+    geração re-ordenada (ou copiada) tem de dar a mesma chave; a ordem do
+    ranking só interessa ao prompt.
+    """
+    key_fields = {k: v for k, v in fields.items() if k != "table"}
+    key_fields["candidates"] = [
+        format_company_row(0, r) for r in sorted(rows_for_prompt, key=lambda r: r["company_id"])
+    ]
+    return llm_cache.make_key("explain", MODEL, key_fields)
+
+def parse_top5(top5, rows_for_prompt):
+    """Valida a resposta do LLM contra os candidatos → [(rank, company_id, explicação)]."""
+    valid_ids = {r["company_id"] for r in rows_for_prompt}
+    id_to_name = {r["company_id"]: r["company_name"] for r in rows_for_prompt}
+
+    ordered = []
+    for i, item in enumerate((top5 or [])[:5]):
+        if not isinstance(item, dict):
+            continue
+        cid = item.get("company_id")
+        if cid in valid_ids:
+            reason = (item.get("reason") or "").strip()
+            exp = f"{id_to_name[cid]} — {reason}" if reason else id_to_name[cid]
+            ordered.append((i + 1, cid, exp))
+    return ordered
+
+def cache_result(cur, job, top5):
+    """Guarda o top5 devolvido pelo LLM (o commit acontece em save_explanations)."""
+    llm_cache.put(cur, job["cache_key"], "explain", MODEL, {"top5": top5})
+
+def save_explanations(conn, cur, job, ordered) -> bool:
+    iid = job["iid"]
+    try:
+        with profiling.span("db.write"):
+            execute_values(
+                cur,
+                """
+                UPDATE match_results AS m
+                SET rank = v.rank, explanation = v.explanation
+                FROM (VALUES %s) AS v(generation, incentive_id, company_id, rank, explanation)
+                WHERE m.generation = v.generation
+                  AND m.incentive_id = v.incentive_id AND m.company_id = v.company_id
+                """,
+                [(job["generation"], iid, cid, rk, exp) for rk, cid, exp in ordered],
+                template="(%s,%s,%s,%s,%s)"
+            )
+            conn.commit()
+        print(f"✅ Atualizado incentivo {iid} — top {len(ordered)} com explicações.")
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Erro ao atualizar incentivo {iid}: {e}")
+        return False
+
+def build_jobs(cur, incentives, generation):
+    """Um job por incentivo com candidatos: secção do prompt batch + nº de tokens."""
+    jobs = []
     for iid, title, desc, crit, elig in incentives:
-        cur.execute("""
-          SELECT m.company_id,
-                 m.score,
-                 COALESCE(m.rule_pass::text, 'null') AS rule_pass_json,
-                 c.company_name,
-                 c.cae_primary_label,
-                 c.trade_description_native
-          FROM matches m
-          JOIN companies c ON c.id = m.company_id
-          WHERE m.incentive_id = %s
-          ORDER BY m.rank
-          LIMIT %s
-        """, (iid, TOP_K_FROM_MATCHES))
-        raw_rows = cur.fetchall()
-        if not raw_rows:
+        rows_for_prompt = fetch_candidates(cur, iid, generation)
+        if not rows_for_prompt:
             print(f"ℹ️  Sem candidatos em matches para incentivo {iid} - '{title[:60]}'")
-            done += 1
             continue
+        fields = prompt_fields(title, desc, crit, elig, rows_for_prompt)
+        section = BATCH_SECTION_TEMPLATE.format(iid=iid, **fields)
+        jobs.append({
+            "iid": iid,
+            "generation": generation,
+            "title": title,
+            "rows": rows_for_prompt,
+            "fields": fields,
+            "section": section,
+            "tokens": count_tokens(section),
+            "cache_key": explain_cache_key(fields, rows_for_prompt),
+        })
+    return jobs
 
-        rows = []
-        for row in raw_rows:
-            try:
-                rule_pass = json.loads(row[2]) if row[2] not in (None, 'null') else False
-                rule_pass = bool(rule_pass)
-            except Exception:
-                rule_pass = False
-            rows.append({
-                "company_id": row[0],
-                "score": float(row[1]),
-                "rule_pass": rule_pass,
-                "company_name": row[3],
-                "cae": row[4],
-                "trade_description": row[5],
-            })
-
-        passed = [r for r in rows if r["rule_pass"]]
-        rows_for_prompt = passed if passed else rows[:TOP_K_FROM_MATCHES]
-
-        table_lines = [format_company_row(i + 1, r) for i, r in enumerate(rows_for_prompt)]
-        table = "\n".join(table_lines)
-
-        prompt = PROMPT_TEMPLATE.format(
-            title=title[:MAX_TEXT],
-            desc=(desc or "")[:MAX_TEXT],
-            crit=(crit or "")[:MAX_TEXT],
-            elig=json.dumps(elig, ensure_ascii=False),
-            k=min(TOP_K_FROM_MATCHES, len(rows_for_prompt)),
-            table=table
-        )
+def apply_cached(conn, cur, jobs):
+    """Re-aplica rankings/razões em cache; devolve os jobs que ainda precisam do LLM."""
+    cached = llm_cache.get_many(cur, [job["cache_key"] for job in jobs])
+    conn.commit()
+
+    pending, hits = [], 0
+    for job in jobs:
+        payload = cached.get(job["cache_key"])
+        ordered = parse_top5((payload or {}).get("top5"), job["rows"])
+        if ordered and save_explanations(conn, cur, job, ordered):
+            hits += 1
+        else:
+            pending.append(job)
+    print(f"💾 Cache: {hits} incentivos reaproveitados, {len(pending)} para o LLM.")
+    return pending
+
+def pack_jobs(jobs, max_tokens=BATCH_MAX_TOKENS):
+    """Agrupa jobs em pedidos cujo input (cabeçalho + secções) fica abaixo do teto."""
+    header_tokens = count_tokens(BATCH_PROMPT_HEADER)
+    packs, current, used = [], [], header_tokens
+    for job in jobs:
+        full = used + job["tokens"] > max_tokens or len(current) >= BATCH_MAX_INCENTIVES
+        if current and full:
+            packs.append(current)
+            current, used = [], header_tokens
+        current.append(job)
+        used += job["tokens"]
+    if current:
+        packs.append(current)
+    return packs
+
+def build_batch_prompt(pack) -> str:
+    return BATCH_PROMPT_HEADER + "".join(job["section"] for job in pack)
+
+def apply_batch_response(conn, cur, pack, content: str):
+    """Valida cada secção de forma independente; devolve os jobs que falharam."""
+    try:
+        with profiling.span("json.parse"):
+            data = json.loads(content)
+        if not isinstance(data, dict):
+            raise ValueError("resposta não é um objeto JSON")
+    except Exception as e:
+        print(f"❌ JSON inválido no pedido batch {[j['iid'] for j in pack]}: {e}")
+        return list(pack)
+
+    failed = []
+    for job in pack:
+        section = data.get(str(job["iid"]))
+        top5 = section.get("top5") if isinstance(section, dict) else section
+        ordered = parse_top5(top5, job["rows"])
+        if not ordered:
+            print(f"⚠️  Secção inválida para incentivo {job['iid']} - '{job['title'][:60]}'")
+            failed.append(job)
+            continue
+        cache_result(cur, job, top5)
+        if not save_explanations(conn, cur, job, ordered):
+            failed.append(job)
+    return failed
+
+def run_single(client, conn, cur, jobs):
+    """Um pedido por incentivo (modo original); devolve quantos ficaram explicados."""
+    done = 0
+    for job in jobs:
+        iid, title = job["iid"], job["title"]
+        prompt = PROMPT_TEMPLATE.format(**job["fields"])
 
         resp = call_chat(client, prompt)
         if not resp:
             print(f"❌ Falha final no incentivo {iid} - '{title[:60]}' (sem resposta após retries)")
-            done += 1
             continue
 
         usage = extract_usage_fields(resp)
@@ -153,57 +328,249 @@ def main():
             model=MODEL,
             prompt_tokens=usage["prompt_tokens"],
             completion_tokens=usage["completion_tokens"],
-            metadata={"incentive_id": iid, "rows": len(rows_for_prompt)}
+            metadata={"incentive_id": iid, "rows": len(job["rows"])}
         )
 
         try:
-            data = json.loads(resp.choices[0].message.content)
+            with profiling.span("json.parse"):
+                data = json.loads(resp.choices[0].message.content)
             top5 = data.get("top5", [])[:5]
         except Exception as e:
             print(f"❌ JSON inválido no incentivo {iid}: {e}")
-            done += 1
             continue
 
-        valid_ids = {r["company_id"] for r in rows_for_prompt}
-        id_to_name = {r["company_id"]: r["company_name"] for r in rows_for_prompt}
-
-        ordered = []
-        for i, item in enumerate(top5):
-            cid = item.get("company_id")
-            if cid in valid_ids:
-                reason = (item.get("reason") or "").strip()
-                exp = f"{id_to_name[cid]} — {reason}" if reason else id_to_name[cid]
-                ordered.append((i + 1, cid, exp))
-
+        ordered = parse_top5(top5, job["rows"])
         if not ordered:
             print(f"⚠️  Sem IDs válidos devolvidos para incentivo {iid} - '{title[:60]}'")
-            done += 1
             continue
 
-        try:
-            execute_values(
-                cur,
-                """
-                UPDATE matches AS m
-                SET rank = v.rank, explanation = v.explanation
-                FROM (VALUES %s) AS v(incentive_id, company_id, rank, explanation)
-                WHERE m.incentive_id = v.incentive_id AND m.company_id = v.company_id
-                """,
-                [(iid, cid, rk, exp) for rk, cid, exp in ordered],
-                template="(%s,%s,%s,%s)"
+        cache_result(cur, job, top5)
+        if save_explanations(conn, cur, job, ordered):
+            done += 1
+        time.sleep(SLEEP_BETWEEN)
+    return done
+
+def run_batched(client, conn, cur, jobs, max_tokens=BATCH_MAX_TOKENS):
+    """Vários incentivos por pedido; só as secções inválidas voltam à fila.
+
+    Devolve quantos incentivos ficaram explicados.
+    """
+    queue = list(jobs)
+    for round_no in range(1, BATCH_ROUNDS + 1):
+        if not queue:
+            break
+        packs = pack_jobs(queue, max_tokens)
+        print(f"📦 Ronda {round_no}: {len(queue)} incentivos em {len(packs)} pedidos")
+        queue = []
+        for pack in packs:
+            resp = call_chat(client, build_batch_prompt(pack))
+            if not resp:
+                print(f"❌ Sem resposta para o pedido batch {[j['iid'] for j in pack]}")
+                queue.extend(pack)
+                continue
+
+            usage = extract_usage_fields(resp)
+            log_usage(
+                source="explain_matches",
+                model=MODEL,
+                prompt_tokens=usage["prompt_tokens"],
+                completion_tokens=usage["completion_tokens"],
+                metadata={"incentive_ids": [j["iid"] for j in pack], "mode": "batch"}
             )
-            conn.commit()
-            print(f"✅ Atualizado incentivo {iid} — top {len(ordered)} com explicações.")
-        except Exception as e:
-            conn.rollback()
-            print(f"❌ Erro ao atualizar incentivo {iid}: {e}")
+            queue.extend(apply_batch_response(conn, cur, pack, resp.choices[0].message.content))
+            time.sleep(SLEEP_BETWEEN)
 
-        done += 1
-        time.sleep(SLEEP_BETWEEN)
+    for job in queue:
+        print(f"❌ Falha final no incentivo {job['iid']} - '{job['title'][:60]}' (batch)")
+    return len(jobs) - len(queue)
 
-    cur.close(); conn.close()
-    print(f"🏁 Concluído: {done}/{total} incentivos processados.")
+# ------------- BATCH API (offline) -------------
+def batch_request_line(pack) -> dict:
+    """Linha JSONL no formato da Batch API (/v1/chat/completions)."""
+    return {
+        "custom_id": "explain:" + ",".join(str(j["iid"]) for j in pack),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": MODEL,
+            "response_format": {"type": "json_object"},
+            "temperature": 0,
+            "messages": [{"role": "user", "content": build_batch_prompt(pack)}],
+        },
+    }
 
-if __name__ == "__main__":
-    main()
+def write_batch_file(jobs, path, max_tokens=BATCH_MAX_TOKENS) -> int:
+    packs = pack_jobs(jobs, max_tokens)
+    with open(path, "w", encoding="utf-8") as fh:
+        for pack in packs:
+            fh.write(json.dumps(batch_request_line(pack), ensure_ascii=False) + "\n")
+    print(f"📝 {len(jobs)} incentivos em {len(packs)} pedidos → {path}")
+    return len(packs)
+
+def ingest_batch_file(conn, cur, jobs, path, max_tokens=BATCH_MAX_TOKENS):
+    """Aplica um ficheiro de resultados da Batch API.
 
+    As secções que falharem são empacotadas de novo em `<path>.retry.jsonl`;
+    linhas ilegíveis são saltadas e contadas (os incentivos delas não se sabem).
+    Devolve (jobs falhados, nº de linhas ilegíveis).
+    """
+    by_id = {job["iid"]: job for job in jobs}
+    failed, bad_lines = [], 0
+    with open(path, encoding="utf-8") as fh:
+        for line_no, line in enumerate(fh, 1):
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+                ids = [int(x) for x in result["custom_id"].split(":", 1)[1].split(",")]
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                print(f"❌ Linha {line_no} ilegível em {path}: {e}")
+                bad_lines += 1
+                continue
+            pack = [by_id[i] for i in ids if i in by_id]
+            missing = [i for i in ids if i not in by_id]
+            if missing:
+                print(f"ℹ️  Incentivos sem candidatos atuais, ignorados: {missing}")
+
+            response = result.get("response") or {}
+            body = response.get("body") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                print(f"❌ Pedido {result['custom_id']} falhou: {result.get('error') or response.get('status_code')}")
+                failed.extend(pack)
+                continue
+
+            usage = body.get("usage") or {}
+            log_usage(
+                source="explain_matches",
+                model=body.get("model", MODEL),
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+                metadata={"incentive_ids": ids, "mode": "batch_api"}
+            )
+            try:
+                content = body["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError) as e:
+                print(f"❌ Pedido {result['custom_id']} sem conteúdo: {e}")
+                failed.extend(pack)
+                continue
+            failed.extend(apply_batch_response(conn, cur, pack, content))
+
+    if bad_lines:
+        print(f"⚠️  {bad_lines} linhas ilegíveis ignoradas em {path}")
+    if failed:
+        retry_path = f"{path}.retry.jsonl"
+        write_batch_file(failed, retry_path, max_tokens)
+        print(f"🔁 {len(failed)} incentivos para re-submeter: {retry_path}")
+    return failed, bad_lines
+
+def main(args=None, conn=None, client=None):
+    """Explica a geração por publicar; devolve o nº da geração (None se não houver).
+
+    `conn`/`client` permitem partilhar ligação e cliente OpenAI (ex.: pipeline.py).
+    """
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    api_key = os.getenv("OPENAI_API_KEY")
+    args = args or parse_args([])
+    # exportar/ingerir ficheiros da Batch API não chama a API
+    needs_api = not (args.export_batch or args.ingest_batch)
+
+    if not db_url and conn is None:
+        print("❌ Falta DATABASE_URL no .env")
+        return
+    if needs_api and not api_key and client is None:
+        print("❌ Falta OPENAI_API_KEY no .env")
+        return
+
+    if needs_api:
+        client = client or OpenAI(api_key=api_key)
+    own_conn = conn is None
+    if own_conn:
+        conn = psycopg2.connect(db_url)
+    cur = conn.cursor()
+
+    if not incentive_activity.schema_ready(cur):
+        incentive_activity.ensure_schema(cur)
+        conn.commit()
+    incentives = fetch_incentives(cur, args.include_inactive)
+    total = len(incentives)
+    print(f"🔎 Incentivos a processar: {total}")
+
+    # trabalha sempre numa geração por publicar; a publicada não é tocada
+    matches_store.ensure_schema(cur)
+    generation = args.generation or matches_store.pending_generation(cur)
+    if generation is None:
+        published = matches_store.published_generation(cur)
+        if published is None:
+            print("❌ Sem gerações de matches — corre primeiro run_match.py")
+            return
+        generation = matches_store.fork_generation(cur, published, "explain_matches.py (re-explicação)")
+    conn.commit()
+    print(f"🧬 Geração de matches: {generation}")
+
+    with profiling.span("build_jobs"):
+        jobs = build_jobs(cur, incentives, generation)
+    llm_cache.ensure_table(cur)
+    conn.commit()
+    with profiling.span("db.cache"):
+        pending = jobs if args.no_cache else apply_cached(conn, cur, jobs)
+
+    attempted = explained = 0
+    if args.export_batch:
+        write_batch_file(pending, args.export_batch, args.batch_max_tokens)
+    elif args.ingest_batch:
+        failed, bad_lines = ingest_batch_file(conn, cur, jobs, args.ingest_batch, args.batch_max_tokens)
+        attempted, explained = len(jobs), len(jobs) - len(failed)
+        if bad_lines:
+            explained = 0  # não se sabe que incentivos ficaram por explicar
+    else:
+        if args.batch:
+            explained = run_batched(client, conn, cur, pending, args.batch_max_tokens)
+        else:
+            explained = run_single(client, conn, cur, pending)
+        attempted = len(pending)
+        print(f"✍️  {explained}/{attempted} incentivos explicados pelo LLM.")
+
+    # com o LLM em baixo a geração ficaria sem explicações: não substitui a publicada
+    incomplete = attempted and explained < args.min_explained * attempted
+    if not args.export_batch and not args.no_publish and not incomplete:
+        matches_store.publish(cur, generation)
+        conn.commit()
+        print(f"📣 Geração {generation} publicada (view matches).")
+
+    cur.close()
+    if own_conn:
+        conn.close()
+    if incomplete:
+        raise SystemExit(
+            f"❌ Só {explained}/{attempted} incentivos explicados (mínimo {args.min_explained:.0%}): "
+            f"geração {generation} fica por publicar — volta a correr para completar."
+        )
+    print(f"🏁 Concluído: {len(jobs)}/{total} incentivos com candidatos processados.")
+    return generation
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reordena matches e gera explicações com LLM.")
+    parser.add_argument("--batch", action="store_true",
+                        help="agrupa vários incentivos por pedido (instruções enviadas uma vez)")
+    parser.add_argument("--batch-max-tokens", type=int, default=BATCH_MAX_TOKENS,
+                        help=f"teto de tokens de input por pedido batch (default: {BATCH_MAX_TOKENS})")
+    parser.add_argument("--export-batch", metavar="JSONL",
+                        help="escreve pedidos para a Batch API em vez de chamar a API")
+    parser.add_argument("--ingest-batch", metavar="JSONL",
+                        help="aplica o ficheiro de resultados devolvido pela Batch API")
+    parser.add_argument("--generation", type=int,
+                        help="geração de matches a explicar (default: última por publicar)")
+    parser.add_argument("--no-publish", action="store_true",
+                        help="não publica a geração no fim (publicar depois com matches_store.py)")
+    parser.add_argument("--min-explained", type=float, default=1.0, metavar="RATIO",
+                        help="fração mínima de incentivos explicados para publicar (default: 1.0)")
+    parser.add_argument("--include-inactive", action="store_true",
+                        help="explica também incentivos fechados/expirados")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="não lê a cache persistente (llm_cache); chama sempre o LLM e atualiza a cache")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    profiling.init("explain_matches")  # --profile / PIPELINE_PROFILE
+    main(parse_args())
@@ -0,0 +1,164 @@
+"""Janela de atividade dos incentivos (datas + estado).
+
+Os incentivos trazem `date_start`, `date_end` e `status` em texto livre.
+Aqui ficam normalizados em colunas indexadas:
+
+    valid_from / valid_to  (timestamptz, a partir de date_start / date_end)
+    is_active              (estado não fechado e date_end ainda não passou)
+
+com um índice parcial sobre os ativos. match.sql, explain_matches.py e
+reverse_match.py só processam incentivos ativos (salvo --include-inactive)
+e o chat ordena os ativos primeiro. Incentivos que ainda não abriram
+(date_start no futuro) contam como ativos: as empresas podem preparar-se.
+
+Como as datas passam, o conjunto ativo tem de ser recalculado periodicamente:
+
+    python incentive_activity.py refresh                 # ex.: cron de hora a hora
+    python incentive_activity.py refresh --every 60      # loop, de 60 em 60 minutos
+    python incentive_activity.py list --inactive
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from typing import Tuple
+
+import psycopg2
+from dotenv import load_dotenv
+
+
+# estados que fecham o incentivo independentemente das datas (regex, sem acentos obrigatórios)
+CLOSED_STATUS_RE = r"^\s*(expired|closed|encerrad|fechad|conclu|terminad|cancelad|suspens|esgotad)"
+
+SCHEMA_DDL = """
+ALTER TABLE incentives
+  ADD COLUMN IF NOT EXISTS status     text,
+  ADD COLUMN IF NOT EXISTS date_start text,
+  ADD COLUMN IF NOT EXISTS date_end   text,
+  ADD COLUMN IF NOT EXISTS valid_from timestamptz,
+  ADD COLUMN IF NOT EXISTS valid_to   timestamptz,
+  ADD COLUMN IF NOT EXISTS is_active  boolean NOT NULL DEFAULT true;
+
+CREATE INDEX IF NOT EXISTS incentives_active_idx
+  ON incentives (incentive_pk) WHERE is_active;
+
+-- o refresh só precisa de olhar para os ativos cujo prazo já passou
+CREATE INDEX IF NOT EXISTS incentives_active_valid_to_idx
+  ON incentives (valid_to) WHERE is_active;
+
+-- datas em texto (CSV) ou já em timestamptz; valores inválidos → NULL
+CREATE OR REPLACE FUNCTION incentive_ts(v text) RETURNS timestamptz
+LANGUAGE plpgsql STABLE AS $$
+BEGIN
+  RETURN NULLIF(btrim(v), '')::timestamptz;
+EXCEPTION WHEN others THEN
+  RETURN NULL;
+END
+$$;
+"""
+
+ACTIVE_EXPR = f"""(
+  COALESCE(status, '') !~* '{CLOSED_STATUS_RE}'
+  AND (valid_to IS NULL OR valid_to >= now())
+)"""
+
+
+def ensure_schema(cur) -> None:
+    """Cria as colunas/índices. O ALTER TABLE leva ACCESS EXCLUSIVE mesmo quando
+    as colunas já existem: chamar só se `schema_ready` for falso."""
+    cur.execute(SCHEMA_DDL)
+
+
+def schema_ready(cur) -> bool:
+    """As colunas já existem? (verificação barata; o ALTER TABLE bloqueia a tabela.)"""
+    cur.execute(
+        """
+        SELECT count(*) = 3 FROM information_schema.columns
+        WHERE table_name = 'incentives'
+          AND column_name IN ('is_active', 'valid_from', 'valid_to')
+        """
+    )
+    return bool(cur.fetchone()[0])
+
+
+def refresh(cur) -> Tuple[int, int]:
+    """Atualiza valid_from/valid_to e is_active; devolve (ativados, desativados)."""
+
+    cur.execute(
+        """
+        UPDATE incentives
+        SET valid_from = incentive_ts(date_start::text),
+            valid_to   = incentive_ts(date_end::text)
+        WHERE (valid_from, valid_to) IS DISTINCT FROM
+              (incentive_ts(date_start::text), incentive_ts(date_end::text))
+        """
+    )
+    cur.execute(
+        f"""
+        UPDATE incentives
+        SET is_active = {ACTIVE_EXPR}
+        WHERE is_active IS DISTINCT FROM {ACTIVE_EXPR}
+        RETURNING is_active
+        """
+    )
+    changed = [r[0] for r in cur.fetchall()]
+    return sum(changed), len(changed) - sum(changed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Recalcula o conjunto de incentivos ativos.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_refresh = sub.add_parser("refresh", help="atualiza is_active a partir das datas e do estado")
+    p_refresh.add_argument("--every", type=float, metavar="MIN",
+                           help="repete de MIN em MIN minutos (em vez de cron)")
+    p_list = sub.add_parser("list", help="lista incentivos ativos (ou inativos)")
+    p_list.add_argument("--inactive", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise SystemExit("DATABASE_URL não definido")
+
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor()
+    if not schema_ready(cur):
+        ensure_schema(cur)
+    conn.commit()
+
+    try:
+        if args.cmd == "refresh":
+            while True:
+                activated, deactivated = refresh(cur)
+                conn.commit()
+                cur.execute("SELECT count(*) FILTER (WHERE is_active), count(*) FROM incentives")
+                active, total = cur.fetchone()
+                print(f"✅ {time.strftime('%Y-%m-%d %H:%M')} ativos={active}/{total} "
+                      f"(+{activated} / -{deactivated})")
+                if not args.every:
+                    break
+                time.sleep(args.every * 60)
+        else:
+            cur.execute(
+                """
+                SELECT incentive_pk, title, status, valid_from, valid_to
+                FROM incentives WHERE is_active = %s
+                ORDER BY valid_to NULLS LAST, incentive_pk
+                """,
+                (not args.inactive,),
+            )
+            rows = cur.fetchall()
+            for iid, title, status, valid_from, valid_to in rows:
+                window = f"{valid_from:%Y-%m-%d}" if valid_from else "—"
+                window += f" → {valid_to:%Y-%m-%d}" if valid_to else " → —"
+                print(f"{iid:>6}  [{status or '—'}] {window}  {title}")
+            print(f"{len(rows)} incentivos {'inativos' if args.inactive else 'ativos'}.")
+    finally:
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Cache persistente de respostas LLM (explicações e elegibilidade).
+
+A chave é um hash dos inputs do prompt já renderizados + modelo, por isso
+um resultado só é reutilizado quando o texto do incentivo, o JSON de
+elegibilidade e a lista exata de candidatos não mudaram.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Any, Dict, Iterable, Optional
+
+from psycopg2.extras import Json
+
+
+TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+  cache_key   text PRIMARY KEY,
+  kind        text NOT NULL,
+  model       text NOT NULL,
+  payload     jsonb NOT NULL,
+  created_at  timestamptz NOT NULL DEFAULT now(),
+  last_hit_at timestamptz,
+  hits        integer NOT NULL DEFAULT 0
+)
+"""
+
+
+def ensure_table(cur) -> None:
+    cur.execute(TABLE_DDL)
+
+
+def make_key(kind: str, model: str, *parts: Any) -> str:
+    """Hash estável (sha256) do tipo de pedido, modelo e inputs do prompt."""
+
+    h = hashlib.sha256()
+    for part in (kind, model, *parts):
+        h.update(json.dumps(part, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+def get_many(cur, keys: Iterable[str]) -> Dict[str, Any]:
+    """Devolve {chave: payload} para as chaves existentes e conta os hits."""
+
+    keys = list(keys)
+    if not keys:
+        return {}
+    cur.execute(
+        """
+        UPDATE llm_cache
+        SET hits = hits + 1, last_hit_at = now()
+        WHERE cache_key = ANY(%s)
+        RETURNING cache_key, payload
+        """,
+        (keys,),
+    )
+    return dict(cur.fetchall())
+
+
+def get(cur, key: str) -> Optional[Any]:
+    return get_many(cur, [key]).get(key)
+
+
+def put(cur, key: str, kind: str, model: str, payload: Any) -> None:
+    """Grava (ou substitui) um resultado. O commit fica a cargo de quem chama."""
+
+    cur.execute(
+        """
+        INSERT INTO llm_cache (cache_key, kind, model, payload)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (cache_key) DO UPDATE
+        SET payload = EXCLUDED.payload, created_at = now()
+        """,
+        (key, kind, model, Json(payload)),
+    )
+
+
+__all__ = ["ensure_table", "make_key", "get", "get_many", "put"]
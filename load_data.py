@@ -0,0 +1,374 @@
+"""Carregamento em bulk dos CSVs de empresas e incentivos.
+
+Lê o CSV em streaming (campos multilinha, JSON grande em `all_data`),
+valida/normaliza as colunas JSON na mesma passagem e envia tudo com
+`COPY ... FROM STDIN` para uma tabela de staging; daí faz upsert pela chave.
+
+Cada linha leva um `content_hash` dos campos que alimentam o embedding:
+só as linhas novas ou cujo hash mudou ficam com `embedding = NULL`
+(nos incentivos também `eligibility = NULL`, e os termos desses incentivos
+saem do índice de elegibilidade) para serem reprocessadas por
+embed_companies.py / embed_incentives_and_eligibility.py.
+Linhas já existentes sem hash (tabelas de antes do `content_hash`) são
+comparadas pelas próprias colunas: o primeiro load só preenche o hash.
+
+O upsert precisa de um índice único na chave. Se a tabela não o tiver, o
+load pára; `--create-key-index` cria-o (depois de verificar que não há
+chaves duplicadas na tabela).
+
+Uso:
+    python load_data.py incentives data/incentives.csv
+    python load_data.py companies data/companies_clean.csv
+    python load_data.py incentives data/incentives.csv --create-key-index
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import psycopg2
+from dotenv import load_dotenv
+
+import eligibility_index
+
+
+# coluna na BD → cabeçalhos aceites no CSV (por ordem de preferência).
+# Cabeçalhos do CSV com o mesmo nome de uma coluna da tabela também são carregados.
+# Cabeçalhos repetidos recebem sufixo: o 2.º "description" do CSV limpo é "description__2".
+TABLES = {
+    "incentives": {
+        "keys": ["incentive_project_id", "incentive_pk"],
+        "columns": {
+            "incentive_project_id": ["incentive_project_id", "incentive_id"],
+            "incentive_pk": ["incentive_pk"],
+            "title": ["title"],
+            "description": ["description"],
+            "ai_description": ["ai_description", "description__2"],
+            "eligibility_criteria": ["eligibility_criteria", "eligibility_text"],
+            "total_budget": ["total_budget", "budget"],
+            "date_start": ["date_start", "start_date"],
+            "date_end": ["date_end", "end_date"],
+            "incentive_program": ["incentive_program", "program"],
+        },
+        "json": ["all_data", "document_urls", "gcs_document_urls"],
+        "hashed": ["title", "description", "ai_description", "eligibility_criteria"],
+        "invalidate": ["embedding", "eligibility"],
+    },
+    "companies": {
+        "keys": ["id"],
+        "columns": {
+            "id": ["id", "company_id"],
+            "company_name": ["company_name", "name"],
+            "cae_primary_label": ["cae_primary_label", "cae"],
+            "trade_description_native": ["trade_description_native", "trade_description"],
+        },
+        "json": [],
+        "hashed": ["trade_description_native", "cae_primary_label", "company_name"],
+        "invalidate": ["embedding"],
+    },
+}
+
+COPY_READ_SIZE = 1 << 16
+
+
+class RowStream:
+    """File-like (só `read`) que gera as linhas CSV a pedido do COPY."""
+
+    def __init__(self, lines: Iterable[str]) -> None:
+        self._lines = iter(lines)
+        self._buf = ""
+
+    def read(self, size: int = -1) -> str:
+        parts = [self._buf]
+        have = len(self._buf)
+        while size < 0 or have < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            parts.append(line)
+            have += len(line)
+        data = "".join(parts)
+        if size < 0 or len(data) <= size:
+            self._buf = ""
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
+
+def dedupe_header(header: List[str]) -> List[str]:
+    seen: Dict[str, int] = {}
+    out = []
+    for name in header:
+        name = name.strip()
+        seen[name] = seen.get(name, 0) + 1
+        out.append(name if seen[name] == 1 else f"{name}__{seen[name]}")
+    return out
+
+
+def table_columns(cur, table: str) -> List[str]:
+    cur.execute(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        ORDER BY ordinal_position
+        """,
+        (table,),
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def has_unique_index(cur, table: str, column: str) -> bool:
+    cur.execute(
+        """
+        SELECT 1
+        FROM pg_index ix
+        JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = ix.indkey[0]
+        WHERE ix.indrelid = %s::regclass AND ix.indisunique
+          AND ix.indnatts = 1 AND a.attname = %s
+        """,
+        (table, column),
+    )
+    return cur.fetchone() is not None
+
+
+def duplicate_keys(cur, table: str, column: str, limit: int = 10) -> List[tuple]:
+    """(chave, nº de linhas) das chaves repetidas na tabela."""
+
+    cur.execute(
+        f"""
+        SELECT {column}, count(*) FROM {table}
+        WHERE {column} IS NOT NULL
+        GROUP BY {column} HAVING count(*) > 1
+        ORDER BY count(*) DESC, {column}
+        LIMIT %s
+        """,
+        (limit,),
+    )
+    return cur.fetchall()
+
+
+def ensure_key_index(cur, table: str, key: str, create: bool) -> None:
+    """O ON CONFLICT precisa de um índice único na chave (ex.: incentive_project_id)."""
+
+    if has_unique_index(cur, table, key):
+        return
+    if not create:
+        raise SystemExit(
+            f"Tabela '{table}' sem índice único em '{key}' (necessário para o upsert). "
+            f"Corre com --create-key-index para o criar."
+        )
+    dups = duplicate_keys(cur, table, key)
+    if dups:
+        listed = ", ".join(f"{k} (×{n})" for k, n in dups)
+        raise SystemExit(
+            f"Não é possível criar o índice único: '{table}.{key}' tem valores repetidos: {listed}. "
+            f"Resolve os duplicados e volta a correr."
+        )
+    cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_{key}_key ON {table} ({key})")
+    print(f"🔑 Índice único criado: {table}_{key}_key")
+
+
+def resolve_mapping(spec: dict, header: List[str], target_cols: List[str]) -> Dict[str, str]:
+    """Coluna da BD → cabeçalho do CSV, só para colunas que existem na tabela."""
+
+    mapping: Dict[str, str] = {}
+    for col, aliases in spec["columns"].items():
+        if col not in target_cols:
+            continue
+        for alias in aliases:
+            if alias in header:
+                mapping[col] = alias
+                break
+    for name in header:
+        if name in target_cols and name not in mapping and name not in mapping.values():
+            mapping[name] = name
+    for col in ("content_hash", *spec["invalidate"]):
+        mapping.pop(col, None)
+    return mapping
+
+
+def content_hash(values: Iterable[Optional[str]]) -> str:
+    h = hashlib.sha256()
+    for v in values:
+        h.update((v or "").strip().encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+def encode_rows(
+    reader: Iterator[Dict[str, str]],
+    mapping: Dict[str, str],
+    spec: dict,
+    stats: dict,
+    rejects: Optional[csv.writer],
+) -> Iterator[str]:
+    """Valida cada linha e devolve-a já em formato CSV para o COPY."""
+
+    cols = list(mapping)
+    json_cols = [c for c in cols if c in spec["json"]]
+    hashed = [c for c in spec["hashed"] if c in mapping]
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+
+    for row in reader:
+        stats["read"] += 1
+        values = {c: (row.get(mapping[c]) or None) for c in cols}
+        try:
+            for c in json_cols:
+                if values[c] is not None:
+                    # normaliza (compacto) para o hash/armazenamento serem estáveis
+                    values[c] = json.dumps(json.loads(values[c]), ensure_ascii=False, separators=(",", ":"))
+        except ValueError as e:
+            stats["rejected"] += 1
+            if rejects is not None:
+                rejects.writerow([stats["read"], c, str(e)])
+            continue
+
+        writer.writerow([values[c] for c in cols] + [content_hash(values[c] for c in hashed)])
+        line = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        yield line
+
+
+def load(conn, table: str, path: str, rejects_path: Optional[str] = None,
+         create_key_index: bool = False) -> dict:
+    spec = TABLES[table]
+    cur = conn.cursor()
+    stats = {"read": 0, "rejected": 0, "inserted": 0, "updated": 0, "invalidated": 0}
+
+    target_cols = table_columns(cur, table)
+    if not target_cols:
+        raise SystemExit(f"Tabela '{table}' não existe")
+    key = next((k for k in spec["keys"] if k in target_cols), None)
+    if key is None:
+        raise SystemExit(f"Tabela '{table}' sem nenhuma das chaves {spec['keys']}")
+
+    ensure_key_index(cur, table, key, create_key_index)
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS content_hash text")
+
+    csv.field_size_limit(sys.maxsize)
+    with contextlib.ExitStack() as stack:
+        fh = stack.enter_context(open(path, newline="", encoding="utf-8"))
+        reader = csv.reader(fh)
+        header = dedupe_header(next(reader))
+        mapping = resolve_mapping(spec, header, target_cols)
+        if key not in mapping:
+            raise SystemExit(f"CSV sem coluna para a chave '{key}' (cabeçalho: {header})")
+        cols = list(mapping)
+        col_list = ", ".join(cols)
+        print(f"📥 {table}: {len(cols)} colunas → {col_list}")
+
+        rejects = None
+        if rejects_path:
+            rejects = csv.writer(stack.enter_context(open(rejects_path, "w", newline="", encoding="utf-8")))
+            rejects.writerow(["csv_row", "column", "error"])
+
+        stage = f"_stage_{table}"
+        cur.execute(f"""
+            CREATE TEMP TABLE {stage} ON COMMIT DROP AS
+            SELECT {col_list}, content_hash FROM {table} WITH NO DATA
+        """)
+        cur.execute(f"ALTER TABLE {stage} ADD COLUMN _ord bigserial")
+
+        dict_rows = (dict(zip(header, r)) for r in reader)
+        cur.copy_expert(
+            f"COPY {stage} ({col_list}, content_hash) FROM STDIN WITH (FORMAT csv)",
+            RowStream(encode_rows(dict_rows, mapping, spec, stats, rejects)),
+            size=COPY_READ_SIZE,
+        )
+
+    invalidate = [c for c in spec["invalidate"] if c in target_cols]
+    # linhas de antes do content_hash (NULL): compara as colunas do hash
+    # diretamente (como content_hash: trim, vazio = NULL) em vez de as dar
+    # todas por alteradas e reprocessar a tabela inteira no primeiro load
+    hashed = [c for c in spec["hashed"] if c in mapping]
+    source_changed = " OR ".join(
+        f"COALESCE(btrim(t.{c}::text), '') IS DISTINCT FROM COALESCE(btrim(EXCLUDED.{c}::text), '')"
+        for c in hashed
+    ) or "FALSE"
+    changed = (
+        "CASE WHEN t.content_hash IS NULL "
+        f"THEN ({source_changed}) "
+        "ELSE t.content_hash IS DISTINCT FROM EXCLUDED.content_hash END"
+    )
+    updates = [f"{c} = EXCLUDED.{c}" for c in cols if c != key]
+    updates.append("content_hash = EXCLUDED.content_hash")
+    updates += [f"{c} = CASE WHEN {changed} THEN NULL ELSE t.{c} END" for c in invalidate]
+    compare = [c for c in cols if c != key] + ["content_hash"]
+    old_row = ", ".join(f"t.{c}" for c in compare)
+    new_row = ", ".join(f"EXCLUDED.{c}" for c in compare)
+    needs_reembed = "embedding IS NULL" if "embedding" in target_cols else "FALSE"
+
+    # DISTINCT ON: se a chave se repetir no CSV, fica a última linha
+    cur.execute(f"""
+        WITH up AS (
+          INSERT INTO {table} AS t ({col_list}, content_hash)
+          SELECT DISTINCT ON ({key}) {col_list}, content_hash
+          FROM {stage}
+          ORDER BY {key}, _ord DESC
+          ON CONFLICT ({key}) DO UPDATE
+          SET {", ".join(updates)}
+          WHERE ({old_row}) IS DISTINCT FROM ({new_row})
+          RETURNING (xmax = 0) AS inserted, {needs_reembed} AS needs_reembed
+        )
+        SELECT count(*) FILTER (WHERE inserted),
+               count(*) FILTER (WHERE NOT inserted),
+               count(*) FILTER (WHERE needs_reembed)
+        FROM up
+    """)
+    stats["inserted"], stats["updated"], stats["invalidated"] = cur.fetchone()
+    if "eligibility" in invalidate and eligibility_index.schema_ready(cur):
+        # elegibilidade anulada → os termos antigos deixam de valer até à nova extração
+        stats["stale_terms"] = eligibility_index.prune_stale(cur)
+    conn.commit()
+    cur.close()
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Carrega CSVs de empresas/incentivos via COPY + upsert.")
+    parser.add_argument("table", choices=sorted(TABLES), help="tabela de destino")
+    parser.add_argument("csv_path", help="caminho para o CSV")
+    parser.add_argument("--rejects", help="CSV onde registar linhas rejeitadas (JSON inválido)")
+    parser.add_argument("--create-key-index", action="store_true",
+                        help="cria o índice único na chave se faltar (verifica duplicados antes)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise SystemExit("DATABASE_URL não definido")
+
+    t0 = time.perf_counter()
+    conn = psycopg2.connect(db_url)
+    try:
+        stats = load(conn, args.table, args.csv_path, args.rejects, args.create_key_index)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    print(
+        f"✅ {args.table}: lidas={stats['read']:,} rejeitadas={stats['rejected']:,} "
+        f"novas={stats['inserted']:,} alteradas={stats['updated']:,} "
+        f"para re-embedding={stats['invalidated']:,} em {time.perf_counter() - t0:.1f}s"
+    )
+    if stats.get("stale_terms"):
+        print(f"🧹 {stats['stale_terms']:,} termos de elegibilidade desatualizados removidos "
+              f"(voltam com embed_incentives_and_eligibility.py).")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
--- usa mais probes se precisares de melhor recall (ajusta k)
-SET ivfflat.probes = 10;
+-- usa mais probes se precisares de melhor recall (ajusta k);
+-- SET LOCAL: só vale nesta transação (em psql corre com `psql -1 -f match.sql`)
+SET LOCAL ivfflat.probes = 10;
 
-TRUNCATE TABLE matches;
+-- escreve numa geração nova de match_results (criada por run_match.py);
+-- a view `matches` só muda quando essa geração for publicada.
+-- Em psql: SET pipeline.generation = <n>;
+-- Só incentivos ativos (incentive_activity.py), salvo SET pipeline.include_inactive = 'on'.
 
 WITH topk AS (
   SELECT
@@ -13,10 +17,11 @@ WITH topk AS (
     c.company_name,
     c.cae_primary_label,
     c.trade_description_native,
-    lower(
+    -- normalização igual à de eligibility_index.norm_sql (minúsculas, espaços colapsados)
+    lower(regexp_replace(btrim(
       COALESCE(c.trade_description_native, '') || ' ' ||
       COALESCE(c.company_name, '')
-    ) AS company_text
+    ), '\s+', ' ', 'g')) AS company_text
   FROM incentives i
   JOIN LATERAL (
     SELECT id, embedding, company_name, cae_primary_label, trade_description_native
@@ -26,6 +31,7 @@ WITH topk AS (
     LIMIT 200
   ) c ON TRUE
   WHERE i.embedding IS NOT NULL
+    AND (i.is_active OR current_setting('pipeline.include_inactive', true) = 'on')
 ),
 rules AS (
   SELECT
@@ -41,7 +47,8 @@ rules AS (
       ELSE EXISTS (
         SELECT 1
         FROM jsonb_array_elements_text(t.eligibility->'allowed_cae_labels') lab
-        WHERE lab ILIKE t.cae_primary_label
+        WHERE lower(regexp_replace(btrim(lab), '\s+', ' ', 'g'))
+            = lower(regexp_replace(btrim(t.cae_primary_label), '\s+', ' ', 'g'))
       )
     END AS passes_cae,
     CASE
@@ -50,13 +57,13 @@ rules AS (
       ELSE NOT EXISTS (
         SELECT 1
         FROM jsonb_array_elements_text(t.eligibility->'keywords_required') kw
-        WHERE t.company_text NOT ILIKE '%'||kw||'%'
+        WHERE position(lower(regexp_replace(btrim(kw), '\s+', ' ', 'g')) IN t.company_text) = 0
       )
     END AS passes_kw_required,
     COALESCE((
       SELECT COUNT(*)
       FROM jsonb_array_elements_text(COALESCE(t.eligibility->'keywords_bonus', '[]'::jsonb)) kwb
-      WHERE t.company_text ILIKE '%'||kwb||'%'
+      WHERE position(lower(regexp_replace(btrim(kwb), '\s+', ' ', 'g')) IN t.company_text) > 0
     ), 0) AS bonus_hits
   FROM topk t
 ),
@@ -91,8 +98,9 @@ ranked AS (
     ) AS rnk
   FROM scored s
 )
-INSERT INTO matches (incentive_id, company_id, score, rank, rule_pass, explanation)
+INSERT INTO match_results (generation, incentive_id, company_id, score, rank, rule_pass, explanation)
 SELECT
+  current_setting('pipeline.generation')::int,
   r.incentive_id,
   r.company_id,
   r.score,
@@ -101,7 +109,7 @@ SELECT
   NULL::text
 FROM ranked r
 WHERE r.rnk <= 5
-ON CONFLICT (incentive_id, company_id) DO UPDATE
+ON CONFLICT (generation, incentive_id, company_id) DO UPDATE
 SET score = EXCLUDED.score,
     rank  = EXCLUDED.rank,
     rule_pass = EXCLUDED.rule_pass;
@@ -0,0 +1,309 @@
+"""Matches versionados por geração (blue/green).
+
+Cada execução do pipeline escreve uma geração nova em `match_results`
+(run_match.py → match.sql → explain_matches.py) e só no fim a publica.
+`matches` passa a ser uma view sobre a última geração publicada, por isso
+a API e o chat nunca veem resultados vazios ou meio explicados.
+
+Gerações anteriores ficam guardadas para rollback e diff:
+
+    python matches_store.py list
+    python matches_store.py publish 12
+    python matches_store.py rollback
+    python matches_store.py diff 11 12
+    python matches_store.py prune --keep 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+from typing import List, Optional, Tuple
+
+import psycopg2
+from dotenv import load_dotenv
+
+
+SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS match_runs (
+  generation   serial PRIMARY KEY,
+  status       text NOT NULL DEFAULT 'building',   -- building | complete | failed
+  created_at   timestamptz NOT NULL DEFAULT now(),
+  completed_at timestamptz,
+  published_at timestamptz,
+  notes        text
+);
+
+CREATE TABLE IF NOT EXISTS match_results (
+  generation   integer NOT NULL REFERENCES match_runs (generation) ON DELETE CASCADE,
+  incentive_id integer NOT NULL,
+  company_id   bigint  NOT NULL,
+  score        double precision,
+  rank         integer,
+  rule_pass    jsonb,
+  explanation  text,
+  PRIMARY KEY (generation, incentive_id, company_id)
+);
+
+CREATE INDEX IF NOT EXISTS match_runs_published_idx
+  ON match_runs (published_at DESC) WHERE published_at IS NOT NULL;
+"""
+
+VIEW_DDL = """
+CREATE OR REPLACE VIEW matches AS
+SELECT r.incentive_id, r.company_id, r.score, r.rank, r.rule_pass, r.explanation, r.generation
+FROM match_results r
+WHERE r.generation = (
+  SELECT generation FROM match_runs
+  WHERE published_at IS NOT NULL
+  ORDER BY published_at DESC
+  LIMIT 1
+)
+"""
+
+
+def ensure_schema(cur) -> None:
+    """Cria as tabelas/view; migra uma tabela `matches` antiga para a geração 1."""
+
+    cur.execute(SCHEMA_DDL)
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('matches')")
+    row = cur.fetchone()
+    if row and row[0] == "r":
+        cur.execute(
+            """
+            INSERT INTO match_runs (status, completed_at, published_at, notes)
+            VALUES ('complete', now(), now(), 'migrado da tabela matches')
+            RETURNING generation
+            """
+        )
+        generation = cur.fetchone()[0]
+        cur.execute(
+            """
+            INSERT INTO match_results (generation, incentive_id, company_id, score, rank, rule_pass, explanation)
+            SELECT %s, incentive_id, company_id, score, rank, to_jsonb(rule_pass), explanation
+            FROM matches
+            """,
+            (generation,),
+        )
+        cur.execute("ALTER TABLE matches RENAME TO matches_legacy")
+    cur.execute(VIEW_DDL)
+
+
+def new_generation(cur, notes: Optional[str] = None) -> int:
+    cur.execute("INSERT INTO match_runs (notes) VALUES (%s) RETURNING generation", (notes,))
+    return cur.fetchone()[0]
+
+
+def mark_complete(cur, generation: int) -> None:
+    cur.execute(
+        "UPDATE match_runs SET status = 'complete', completed_at = now() WHERE generation = %s",
+        (generation,),
+    )
+
+
+def mark_failed(cur, generation: int) -> None:
+    """Geração que não chegou ao fim (ex.: match.sql falhou): nunca é publicada e o prune apaga-a."""
+
+    cur.execute(
+        "UPDATE match_runs SET status = 'failed', completed_at = now() WHERE generation = %s",
+        (generation,),
+    )
+
+
+def published_generation(cur) -> Optional[int]:
+    cur.execute(
+        """
+        SELECT generation FROM match_runs
+        WHERE published_at IS NOT NULL
+        ORDER BY published_at DESC LIMIT 1
+        """
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def pending_generation(cur) -> Optional[int]:
+    """Última geração completa, mais recente do que a publicada e ainda por publicar."""
+
+    cur.execute(
+        """
+        SELECT generation FROM match_runs
+        WHERE status = 'complete' AND published_at IS NULL
+          AND generation > COALESCE((
+            SELECT generation FROM match_runs
+            WHERE published_at IS NOT NULL
+            ORDER BY published_at DESC LIMIT 1), 0)
+        ORDER BY generation DESC LIMIT 1
+        """
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def fork_generation(cur, source: int, notes: Optional[str] = None) -> int:
+    """Copia uma geração para uma nova (completa, por publicar)."""
+
+    generation = new_generation(cur, notes or f"cópia da geração {source}")
+    cur.execute(
+        """
+        INSERT INTO match_results (generation, incentive_id, company_id, score, rank, rule_pass, explanation)
+        SELECT %s, incentive_id, company_id, score, rank, rule_pass, explanation
+        FROM match_results WHERE generation = %s
+        """,
+        (generation, source),
+    )
+    mark_complete(cur, generation)
+    return generation
+
+
+def publish(cur, generation: int) -> None:
+    """Troca atómica: a view `matches` passa a ler esta geração após o commit."""
+
+    cur.execute(
+        """
+        UPDATE match_runs SET published_at = now()
+        WHERE generation = %s AND status = 'complete'
+        """,
+        (generation,),
+    )
+    if cur.rowcount != 1:
+        raise SystemExit(f"Geração {generation} não existe ou não está completa")
+
+
+def rollback(cur) -> int:
+    """Volta a publicar a geração publicada antes da atual."""
+
+    cur.execute(
+        """
+        SELECT generation FROM match_runs
+        WHERE published_at IS NOT NULL
+        ORDER BY published_at DESC
+        OFFSET 1 LIMIT 1
+        """
+    )
+    row = cur.fetchone()
+    if not row:
+        raise SystemExit("Não há geração anterior para rollback")
+    publish(cur, row[0])
+    return row[0]
+
+
+def diff(cur, old: int, new: int) -> List[Tuple]:
+    """Incentivos cujo top (empresa → rank) mudou entre duas gerações."""
+
+    cur.execute(
+        """
+        WITH a AS (
+          SELECT incentive_id, array_agg(company_id ORDER BY rank) AS top
+          FROM match_results WHERE generation = %s GROUP BY incentive_id
+        ), b AS (
+          SELECT incentive_id, array_agg(company_id ORDER BY rank) AS top
+          FROM match_results WHERE generation = %s GROUP BY incentive_id
+        )
+        SELECT COALESCE(a.incentive_id, b.incentive_id), a.top, b.top
+        FROM a FULL JOIN b ON a.incentive_id = b.incentive_id
+        WHERE a.top IS DISTINCT FROM b.top
+        ORDER BY 1
+        """,
+        (old, new),
+    )
+    return cur.fetchall()
+
+
+def prune(cur, keep: int = 5) -> int:
+    """Apaga gerações antigas, mantendo as `keep` mais recentes publicadas e as pendentes.
+
+    A geração servida agora nunca é apagada (depois de um rollback pode não
+    ser a mais recente); gerações falhadas são sempre apagadas.
+    """
+
+    if keep < 1:
+        raise SystemExit("prune: --keep tem de ser ≥ 1")
+    current = published_generation(cur)
+    cur.execute(
+        """
+        DELETE FROM match_runs
+        WHERE generation IS DISTINCT FROM %(current)s
+          AND (
+            status = 'failed'
+            OR (generation NOT IN (
+                  SELECT generation FROM match_runs
+                  WHERE published_at IS NOT NULL
+                  ORDER BY published_at DESC LIMIT %(keep)s)
+                AND generation < (SELECT COALESCE(max(generation), 0)
+                                  FROM match_runs WHERE published_at IS NOT NULL))
+          )
+        """,
+        {"current": current, "keep": keep},
+    )
+    return cur.rowcount
+
+
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("tem de ser ≥ 1")
+    return n
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Gere as gerações de matches (publicar, rollback, diff).")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list", help="lista gerações")
+    p_pub = sub.add_parser("publish", help="publica uma geração completa")
+    p_pub.add_argument("generation", type=int)
+    sub.add_parser("rollback", help="volta à geração publicada anteriormente")
+    p_diff = sub.add_parser("diff", help="incentivos com top diferente entre duas gerações")
+    p_diff.add_argument("old", type=int)
+    p_diff.add_argument("new", type=int)
+    p_prune = sub.add_parser("prune", help="apaga gerações antigas")
+    p_prune.add_argument("--keep", type=positive_int, default=5)
+    args = parser.parse_args()
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise SystemExit("DATABASE_URL não definido")
+
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor()
+    ensure_schema(cur)
+
+    if args.cmd == "list":
+        current = published_generation(cur)
+        cur.execute(
+            """
+            SELECT r.generation, r.status, r.created_at, r.published_at, r.notes,
+                   (SELECT count(*) FROM match_results m WHERE m.generation = r.generation),
+                   (SELECT count(*) FROM match_results m
+                    WHERE m.generation = r.generation AND m.explanation IS NOT NULL)
+            FROM match_runs r ORDER BY r.generation DESC
+            """
+        )
+        for gen, status, created, published, notes, rows, explained in cur.fetchall():
+            flag = "★" if gen == current else " "
+            published_txt = f"{published:%Y-%m-%d %H:%M}" if published else "—"
+            print(
+                f"{flag} {gen:>4} {status:<9} criada={created:%Y-%m-%d %H:%M} "
+                f"publicada={published_txt} linhas={rows} explicadas={explained} {notes or ''}"
+            )
+    elif args.cmd == "publish":
+        publish(cur, args.generation)
+        print(f"✅ Geração {args.generation} publicada.")
+    elif args.cmd == "rollback":
+        print(f"⏪ Geração {rollback(cur)} publicada de novo.")
+    elif args.cmd == "diff":
+        rows = diff(cur, args.old, args.new)
+        for iid, old_top, new_top in rows:
+            print(f"Incentivo {iid}: {old_top} → {new_top}")
+        print(f"{len(rows)} incentivos com top diferente.")
+    elif args.cmd == "prune":
+        print(f"🧹 {prune(cur, args.keep)} gerações apagadas.")
+
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
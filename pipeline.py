@@ -0,0 +1,321 @@
+"""Orquestrador do pipeline completo (DAG com checkpoints).
+
+    embed_companies  ─┬─► run_match ─► explain_matches
+    embed_incentives ─┤
+                      └─► reverse_match
+
+Etapas independentes correm em paralelo (os dois embeddings, e depois
+reverse_match ao lado de run_match/explain_matches), partilhando um pool de
+ligações Postgres e um cliente OpenAI. O estado de cada etapa fica num
+checkpoint JSON; se o pipeline falhar, a execução seguinte salta as etapas
+concluídas e retoma as restantes. Dentro de cada etapa o progresso também é
+retomável: os embeddings e o reverse_match só processam linhas em falta
+(commits por lote) e o explain_matches reutiliza a geração do run_match e as
+explicações já em cache (llm_cache).
+
+    python pipeline.py                    # corre ou retoma
+    python pipeline.py --fresh            # ignora o checkpoint
+    python pipeline.py --only run_match explain_matches
+    python pipeline.py --status           # mostra o checkpoint
+
+No fim imprime o tempo de cada etapa, a soma e o caminho crítico.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from openai import OpenAI
+from psycopg2.pool import ThreadedConnectionPool
+
+import profiling
+
+
+CHECKPOINT_PATH = os.getenv("PIPELINE_CHECKPOINT", ".pipeline_checkpoint.json")
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class Checkpoint:
+    """Estado das etapas num ficheiro JSON (escrita atómica a cada mudança)."""
+
+    def __init__(self, path: str, fresh: bool = False) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = None
+        if not fresh and os.path.exists(path):
+            with open(path, encoding="utf-8") as fh:
+                self.data = json.load(fh)
+            if self.data.get("finished_at"):
+                self.data = None  # execução anterior terminou: começa uma nova
+        if self.data is None:
+            self.data = {"run_id": datetime.now().strftime("%Y%m%d-%H%M%S"),
+                         "created_at": now_iso(), "finished_at": None, "stages": {}}
+
+    def stage(self, name: str) -> dict:
+        return self.data["stages"].get(name, {})
+
+    def status(self, name: str) -> Optional[str]:
+        return self.stage(name).get("status")
+
+    def result(self, name: str) -> dict:
+        return self.stage(name).get("result") or {}
+
+    def update(self, name: str, **fields) -> None:
+        with self._lock:
+            self.data["stages"].setdefault(name, {}).update(fields)
+            self._save()
+
+    def finish(self) -> None:
+        with self._lock:
+            self.data["finished_at"] = now_iso()
+            self._save()
+
+    def _save(self) -> None:
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(self.data, fh, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+
+class PipelineContext:
+    """Recursos partilhados pelas etapas: pool de ligações, cliente OpenAI, checkpoint."""
+
+    def __init__(self, args, checkpoint: Checkpoint, db_url: str, api_key: str) -> None:
+        self.args = args
+        self.checkpoint = checkpoint
+        self.pool = ThreadedConnectionPool(1, args.max_parallel + 1, db_url)
+        self.client = OpenAI(api_key=api_key, max_retries=5)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        broken = False
+        try:
+            yield conn
+        except BaseException:
+            broken = True
+            with contextlib.suppress(Exception):
+                conn.rollback()
+            raise
+        finally:
+            if not broken and not conn.closed:
+                # nada de parâmetros de sessão de uma etapa para a seguinte
+                conn.rollback()
+                with conn.cursor() as cur:
+                    cur.execute("RESET ALL")
+                conn.commit()
+            self.pool.putconn(conn, close=broken or conn.closed)
+
+    def close(self) -> None:
+        self.pool.closeall()
+        self.client.close()
+
+
+# ---------------------------------------------------------------- etapas
+
+def stage_embed_companies(ctx: PipelineContext) -> dict:
+    import embed_companies
+    with ctx.connection() as conn:
+        return {"updated": embed_companies.main(conn=conn, client=ctx.client)}
+
+
+def stage_embed_incentives(ctx: PipelineContext) -> dict:
+    import embed_incentives_and_eligibility
+    with ctx.connection() as conn:
+        return {"processed": embed_incentives_and_eligibility.main(conn=conn, client=ctx.client)}
+
+
+def stage_run_match(ctx: PipelineContext) -> dict:
+    import run_match
+    argv = ["--include-inactive"] if ctx.args.include_inactive else []
+    with ctx.connection() as conn:
+        return {"generation": run_match.main(run_match.parse_args(argv), conn=conn)}
+
+
+def stage_explain_matches(ctx: PipelineContext) -> dict:
+    import explain_matches
+    argv = []
+    generation = ctx.checkpoint.result("run_match").get("generation")
+    if generation:
+        argv += ["--generation", str(generation)]  # ao retomar, continua a mesma geração
+    if ctx.args.batch:
+        argv.append("--batch")
+    if ctx.args.include_inactive:
+        argv.append("--include-inactive")
+    if ctx.args.no_publish:
+        argv.append("--no-publish")
+    with ctx.connection() as conn:
+        generation = explain_matches.main(explain_matches.parse_args(argv), conn=conn, client=ctx.client)
+    return {"generation": generation}
+
+
+def stage_reverse_match(ctx: PipelineContext) -> dict:
+    import reverse_match
+    with ctx.connection() as conn:
+        return {"companies": reverse_match.refresh(conn)}
+
+
+STAGES = {
+    "embed_companies":  {"deps": [], "run": stage_embed_companies},
+    "embed_incentives": {"deps": [], "run": stage_embed_incentives},
+    "run_match":        {"deps": ["embed_companies", "embed_incentives"], "run": stage_run_match},
+    "explain_matches":  {"deps": ["run_match"], "run": stage_explain_matches},
+    "reverse_match":    {"deps": ["embed_companies", "embed_incentives"], "run": stage_reverse_match},
+}
+
+
+# ---------------------------------------------------------------- execução
+
+def run_stage(ctx: PipelineContext, name: str) -> dict:
+    ctx.checkpoint.update(name, status="running", started_at=now_iso(), error=None)
+    print(f"▶️  {name}")
+    t0 = time.perf_counter()
+    try:
+        with profiling.span(f"stage:{name}"):
+            result = STAGES[name]["run"](ctx)
+    except (Exception, SystemExit) as e:
+        wall = time.perf_counter() - t0
+        ctx.checkpoint.update(name, status="failed", finished_at=now_iso(), wall_s=wall,
+                              error=f"{type(e).__name__}: {e}")
+        traceback.print_exc()
+        print(f"❌ {name} falhou ao fim de {wall:.1f}s: {e}")
+        raise
+    wall = time.perf_counter() - t0
+    ctx.checkpoint.update(name, status="done", finished_at=now_iso(), wall_s=wall, result=result)
+    print(f"✅ {name} em {wall:.1f}s {result}")
+    return result
+
+
+def schedule(ctx: PipelineContext, selected: List[str]) -> Dict[str, str]:
+    """Corre as etapas selecionadas respeitando as dependências; devolve o estado final."""
+
+    ckpt = ctx.checkpoint
+    outcome = {n: "done (checkpoint)" for n in selected if ckpt.status(n) == "done"}
+    pending = [n for n in selected if n not in outcome]
+
+    def ready(name: str) -> Optional[bool]:
+        """True = pode correr; False = ainda não; None = bloqueada por falha."""
+        for dep in STAGES[name]["deps"]:
+            if dep not in selected:
+                continue  # fora da seleção: assume-se já feita
+            state = outcome.get(dep)
+            if state in ("failed", "blocked"):
+                return None
+            if state is None or state == "running":
+                return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=ctx.args.max_parallel, thread_name_prefix="stage") as pool:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                ok = ready(name)
+                if ok is None:
+                    pending.remove(name)
+                    outcome[name] = "blocked"
+                    ckpt.update(name, status="blocked")
+                    print(f"⏭️  {name} não corre (dependência falhou)")
+                elif ok and len(running) < ctx.args.max_parallel:
+                    pending.remove(name)
+                    outcome[name] = "running"
+                    running[pool.submit(run_stage, ctx, name)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                outcome[name] = "failed" if fut.exception() else "done"
+    return outcome
+
+
+def critical_path(walls: Dict[str, float], selected: List[str]):
+    """Caminho mais longo no DAG (tempo total, etapas)."""
+
+    best: Dict[str, tuple] = {}
+    for name in STAGES:  # STAGES está em ordem topológica
+        if name not in selected:
+            continue
+        prev = max(
+            (best[d] for d in STAGES[name]["deps"] if d in best),
+            key=lambda b: b[0], default=(0.0, []),
+        )
+        best[name] = (prev[0] + walls.get(name, 0.0), prev[1] + [name])
+    return max(best.values(), key=lambda b: b[0], default=(0.0, []))
+
+
+def print_report(ckpt: Checkpoint, selected: List[str], outcome: Dict[str, str], elapsed: float) -> None:
+    walls = {n: ckpt.stage(n).get("wall_s", 0.0) for n in selected if outcome.get(n) == "done"}
+    print("\n📊 Etapas:")
+    for name in selected:
+        state = outcome.get(name, ckpt.status(name) or "—")
+        wall = ckpt.stage(name).get("wall_s")
+        wall_txt = f"{wall:8.1f}s" if wall is not None and state in ("done", "failed") else "        —"
+        print(f"  {name:<18} {wall_txt}  {state}")
+    cp_time, cp_stages = critical_path(walls, selected)
+    print(f"  soma das etapas   {sum(walls.values()):8.1f}s")
+    print(f"  caminho crítico   {cp_time:8.1f}s  ({' → '.join(cp_stages) or '—'})")
+    print(f"  tempo total       {elapsed:8.1f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Corre o pipeline completo (embeddings → match → explicações).")
+    parser.add_argument("--only", nargs="+", choices=list(STAGES), help="só estas etapas")
+    parser.add_argument("--skip", nargs="+", choices=list(STAGES), default=[], help="salta estas etapas")
+    parser.add_argument("--fresh", action="store_true", help="ignora o checkpoint e recomeça")
+    parser.add_argument("--status", action="store_true", help="mostra o checkpoint e sai")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help=f"ficheiro de checkpoint (default: {CHECKPOINT_PATH})")
+    parser.add_argument("--max-parallel", type=int, default=3, help="etapas em simultâneo")
+    parser.add_argument("--batch", action="store_true", help="explain_matches em modo batch")
+    parser.add_argument("--include-inactive", action="store_true", help="inclui incentivos inativos")
+    parser.add_argument("--no-publish", action="store_true", help="não publica a geração no fim")
+    args = parser.parse_args()
+
+    selected = [n for n in STAGES if (not args.only or n in args.only) and n not in args.skip]
+    ckpt = Checkpoint(args.checkpoint, fresh=args.fresh)
+
+    if args.status:
+        print(json.dumps(ckpt.data, ensure_ascii=False, indent=2))
+        return
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not db_url or not api_key:
+        raise SystemExit("Faltam DATABASE_URL ou OPENAI_API_KEY no .env")
+
+    resumed = [n for n in selected if ckpt.status(n) == "done"]
+    print(f"🚀 Pipeline {ckpt.data['run_id']}: {', '.join(selected)}"
+          + (f" (retoma; já feitas: {', '.join(resumed)})" if resumed else ""))
+
+    ctx = PipelineContext(args, ckpt, db_url, api_key)
+    t0 = time.perf_counter()
+    try:
+        outcome = schedule(ctx, selected)
+    finally:
+        ctx.close()
+    elapsed = time.perf_counter() - t0
+
+    print_report(ckpt, selected, outcome, elapsed)
+    if all(state.startswith("done") for state in outcome.values()):
+        ckpt.finish()
+        print("🏁 Pipeline concluído.")
+    else:
+        raise SystemExit(f"Pipeline incompleto — volta a correr para retomar ({args.checkpoint}).")
+
+
+if __name__ == "__main__":
+    profiling.init("pipeline")  # --profile / PIPELINE_PROFILE
+    main()
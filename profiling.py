@@ -0,0 +1,363 @@
+"""Instrumentação dos scripts do pipeline (run_match, embed_*, explain_matches).
+
+Tudo desligado por omissão; liga-se com a flag `--profile[=MODOS]` em
+qualquer script ou com `PIPELINE_PROFILE=MODOS` no ambiente:
+
+    python run_match.py --profile                    # só spans
+    PIPELINE_PROFILE=spans,sample python embed_companies.py
+    python explain_matches.py --batch --profile=all
+
+Modos:
+- `spans`    tempos por secção (`with profiling.span("db.fetch"):`), agregados
+             em árvore (nº de chamadas, total, tempo próprio); resumo no fim.
+- `sample`   profiler por amostragem (thread, stack de todas as threads a cada
+             PIPELINE_PROFILE_INTERVAL ms, uma raiz por thread) → `.speedscope.json`
+             (speedscope.app) e `.folded` (flamegraph.pl / inferno).
+- `cprofile` cProfile determinístico → `.pstats` (snakeviz, pstats); só a
+             thread principal — para o pipeline.py usar `sample`.
+- `explain`  EXPLAIN (ANALYZE, BUFFERS) das queries que passam por
+             `profiling.execute` → planos em JSON + resumo (tempo, buffers).
+- `all`      todos os anteriores.
+
+Os ficheiros vão para PIPELINE_PROFILE_DIR (default `profiles/`).
+"""
+
+from __future__ import annotations
+
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+
+MODES = ("spans", "sample", "cprofile", "explain")
+PROFILE_DIR = os.getenv("PIPELINE_PROFILE_DIR", "profiles")
+SAMPLE_INTERVAL_MS = float(os.getenv("PIPELINE_PROFILE_INTERVAL", "5"))
+
+_modes: set = set()
+_name = "pipeline"
+_started = 0.0
+_lock = threading.Lock()
+_local = threading.local()
+# caminho (tuplo de nomes) → [chamadas, total s, tempo dos filhos s]
+_spans: Dict[Tuple[str, ...], List[float]] = {}
+_explains: List[dict] = []
+_explained: set = set()
+_profiler: Optional[cProfile.Profile] = None
+_sampler: Optional["_Sampler"] = None
+
+
+def parse_modes(value: Optional[str]) -> set:
+    if value is None:
+        return set()
+    value = value.strip().lower()
+    if value in ("", "1", "true", "on", "yes"):
+        return {"spans"}
+    if value in ("0", "false", "off", "no"):
+        return set()
+    modes = {m.strip() for m in value.split(",") if m.strip()}
+    if "all" in modes:
+        return set(MODES)
+    unknown = modes - set(MODES)
+    if unknown:
+        raise SystemExit(f"PIPELINE_PROFILE: modos desconhecidos {sorted(unknown)} (válidos: {', '.join(MODES)}, all)")
+    return modes | {"spans"}
+
+
+def init(name: str, argv: Optional[List[str]] = None) -> set:
+    """Lê `--profile[=MODOS]` (retirando-o de argv) ou PIPELINE_PROFILE e arranca os profilers.
+
+    Chamar no início do script, antes do argparse.
+    """
+
+    global _modes, _name, _started, _profiler, _sampler
+    argv = sys.argv if argv is None else argv
+    value = os.getenv("PIPELINE_PROFILE")
+    for arg in list(argv[1:]):
+        if arg == "--profile" or arg.startswith("--profile="):
+            argv.remove(arg)
+            value = arg.partition("=")[2]
+
+    _modes = parse_modes(value)
+    _name = name
+    _started = time.perf_counter()
+    if not _modes:
+        return _modes
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if "cprofile" in _modes:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if "sample" in _modes:
+        _sampler = _Sampler(SAMPLE_INTERVAL_MS / 1000.0)
+        _sampler.start()
+    atexit.register(report)
+    return _modes
+
+
+def enabled(mode: str = "spans") -> bool:
+    return mode in _modes
+
+
+# ---------------------------------------------------------------- spans
+
+class _Span:
+    __slots__ = ("name", "t0", "child")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.child = 0.0
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+        stack = _local.stack
+        path = tuple(s.name for s in stack)
+        stack.pop()
+        if stack:
+            stack[-1].child += elapsed
+        with _lock:
+            agg = _spans.setdefault(path, [0, 0.0, 0.0])
+            agg[0] += 1
+            agg[1] += elapsed
+            agg[2] += self.child
+        return False
+
+
+_NULL = contextlib.nullcontext()
+
+
+def span(name: str):
+    """Secção cronometrada; spans dentro de spans agregam-se por caminho."""
+
+    return _Span(name) if "spans" in _modes else _NULL
+
+
+# ---------------------------------------------------------------- sampling
+
+class _Sampler(threading.Thread):
+    """Amostra a stack de todas as threads a intervalos fixos.
+
+    Cada stack começa por um frame `thread:<nome>`, para que as etapas do
+    pipeline.py (threads do executor) apareçam separadas da thread principal.
+    """
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.frames: Dict[Tuple[str, str, int], int] = {}
+        self._halt = threading.Event()
+
+    def _frame_id(self, code) -> int:
+        return self._key_id((code.co_name, code.co_filename, code.co_firstlineno))
+
+    def _key_id(self, key: Tuple[str, str, int]) -> int:
+        fid = self.frames.get(key)
+        if fid is None:
+            fid = self.frames[key] = len(self.frames)
+        return fid
+
+    def run(self) -> None:
+        last = time.perf_counter()
+        while not self._halt.wait(self.interval):
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_id(frame.f_code))
+                    frame = frame.f_back
+                stack.append(self._key_id((f"thread:{names.get(ident, ident)}", "", 0)))
+                self.stacks[tuple(reversed(stack))] += now - last
+            last = now
+
+    def stop(self) -> None:
+        self._halt.set()
+        self.join(timeout=1.0)
+
+    def write(self, base: str) -> List[str]:
+        names = sorted(self.frames, key=self.frames.get)
+        stacks = list(self.stacks.items())
+        speedscope = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": _name,
+            "exporter": "profiling.py",
+            "shared": {"frames": [{"name": n, "file": f, "line": line} for n, f, line in names]},
+            "profiles": [{
+                "type": "sampled",
+                "name": _name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(w for _, w in stacks),
+                "samples": [list(s) for s, _ in stacks],
+                "weights": [w for _, w in stacks],
+            }],
+        }
+        with open(f"{base}.speedscope.json", "w", encoding="utf-8") as fh:
+            json.dump(speedscope, fh)
+        with open(f"{base}.folded", "w", encoding="utf-8") as fh:
+            for stack, weight in stacks:
+                label = ";".join(
+                    f"{names[i][0]} ({os.path.basename(names[i][1])}:{names[i][2]})" for i in stack
+                )
+                fh.write(f"{label} {max(1, round(weight * 1000))}\n")  # peso em ms
+        return [f"{base}.speedscope.json", f"{base}.folded"]
+
+
+# ---------------------------------------------------------------- EXPLAIN
+
+_NOT_EXPLAINABLE = re.compile(r"^\s*(SET|RESET|CREATE|ALTER|DROP|TRUNCATE|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|COPY|VACUUM|ANALYZE\s)", re.I)
+_READ_ONLY = re.compile(r"^\s*(SELECT|VALUES|TABLE|SHOW)\b", re.I)
+_WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b", re.I)
+
+
+def _returns_rows(stmt: str) -> bool:
+    if _READ_ONLY.match(stmt) or re.search(r"\bRETURNING\b", stmt, re.I):
+        return True
+    return stmt.lstrip()[:4].upper() == "WITH" and not _WRITES.search(stmt)
+
+
+def _statements(sql: str) -> List[str]:
+    """Divide um ficheiro SQL simples (sem ';' dentro de strings) em statements."""
+
+    out = []
+    for part in sql.split(";"):
+        body = "\n".join(l for l in part.splitlines() if not l.strip().startswith("--")).strip()
+        if body:
+            out.append(body)
+    return out
+
+
+def execute(cur, sql: str, params=None, label: Optional[str] = None) -> None:
+    """`cur.execute` que, com o modo `explain`, guarda o plano EXPLAIN (ANALYZE, BUFFERS).
+
+    - escritas sem resultados correm uma só vez, através do próprio EXPLAIN ANALYZE;
+    - queries que devolvem linhas: EXPLAIN num savepoint (revertido) e depois a query real;
+    - SQL com vários statements (ex.: match.sql) é dividido e cada um tratado à parte;
+    - queries repetidas (ex.: uma por incentivo) só são explicadas na 1.ª vez por `label`.
+    """
+
+    label = label or sql.strip().split("\n", 1)[0][:60]
+    with span(f"sql:{label}"):
+        with _lock:
+            first = label not in _explained
+            _explained.add(label)
+        if "explain" not in _modes or not first:
+            cur.execute(sql, params)
+            return
+        statements = _statements(sql) if params is None else [sql]
+        for n, stmt in enumerate(statements):
+            if _NOT_EXPLAINABLE.match(stmt):
+                cur.execute(stmt, params)
+                continue
+            stmt_label = label if len(statements) == 1 else f"{label}#{n + 1}"
+            explain = f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {stmt}"
+            if _returns_rows(stmt):
+                autocommit = cur.connection.autocommit
+                cur.execute("BEGIN" if autocommit else "SAVEPOINT profiling_explain")
+                try:
+                    cur.execute(explain, params)
+                    _record_plan(stmt_label, cur.fetchone()[0])
+                finally:
+                    cur.execute("ROLLBACK" if autocommit else "ROLLBACK TO SAVEPOINT profiling_explain")
+                cur.execute(stmt, params)
+            else:
+                cur.execute(explain, params)
+                _record_plan(stmt_label, cur.fetchone()[0])
+
+
+def _record_plan(label: str, plan) -> None:
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    top = plan[0]
+    node = top["Plan"]
+    summary = {
+        "label": label,
+        "execution_ms": top.get("Execution Time"),
+        "planning_ms": top.get("Planning Time"),
+        "rows": node.get("Actual Rows"),
+        "shared_hit": node.get("Shared Hit Blocks"),
+        "shared_read": node.get("Shared Read Blocks"),
+        "temp_written": node.get("Temp Written Blocks"),
+    }
+    with _lock:
+        _explains.append({"summary": summary, "plan": plan})
+    print(
+        f"🔬 EXPLAIN {label}: {summary['execution_ms'] or 0:.1f} ms, linhas={summary['rows']}, "
+        f"buffers hit={summary['shared_hit']} read={summary['shared_read']} temp={summary['temp_written']}"
+    )
+
+
+# ---------------------------------------------------------------- relatório
+
+def _format_tree() -> List[str]:
+    lines = []
+    for path in sorted(_spans):
+        count, total, child = _spans[path]
+        indent = "  " * (len(path) - 1)
+        lines.append(
+            f"  {indent}{path[-1]:<{max(8, 40 - len(indent))}} {int(count):>7}×  "
+            f"{total:9.2f}s  (próprio {total - child:.2f}s)"
+        )
+    return lines
+
+
+def report() -> None:
+    """Fecha os profilers e escreve/imprime os resultados (chamado no exit)."""
+
+    global _profiler, _sampler
+    if not _modes:
+        return
+    elapsed = time.perf_counter() - _started
+    base = os.path.join(PROFILE_DIR, f"{_name}-{time.strftime('%Y%m%d-%H%M%S')}")
+    files = []
+
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(f"{base}.pstats")
+        files.append(f"{base}.pstats")
+        _profiler = None
+    if _sampler is not None:
+        _sampler.stop()
+        files += _sampler.write(base)
+        _sampler = None
+
+    if _spans:
+        with open(f"{base}.spans.json", "w", encoding="utf-8") as fh:
+            json.dump(
+                [{"path": list(p), "count": int(c), "total_s": t, "self_s": t - ch}
+                 for p, (c, t, ch) in sorted(_spans.items())],
+                fh, ensure_ascii=False, indent=2,
+            )
+        files.append(f"{base}.spans.json")
+    if _explains:
+        with open(f"{base}.explain.json", "w", encoding="utf-8") as fh:
+            json.dump(_explains, fh, ensure_ascii=False, indent=2)
+        files.append(f"{base}.explain.json")
+
+    print(f"\n⏱️  Perfil {_name}: {elapsed:.2f}s")
+    for line in _format_tree():
+        print(line)
+    for path in files:
+        print(f"   → {path}")
+
+
+__all__ = ["init", "enabled", "span", "execute", "report", "parse_modes"]
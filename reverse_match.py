@@ -0,0 +1,255 @@
+"""Matching inverso: top incentivos de cada empresa, pré-calculado.
+
+match.sql responde "top-5 empresas por incentivo"; aqui calcula-se o
+sentido contrário com o mesmo score (0.70 × similaridade + 0.25 × regras +
+0.05 × keywords bónus) e guarda-se numa linha compacta por empresa:
+
+    company_incentives (company_id, incentive_ids[], scores[], rule_pass[], computed_at)
+
+As empresas processam-se em lotes por ordem de id (cada lote é um commit,
+por isso uma execução interrompida continua onde parou). Por omissão só se
+calculam as empresas com embedding e sem linha — embed_companies.py apaga a
+linha das empresas que re-embeda, por isso o refresh é incremental.
+Só entram incentivos ativos (incentive_activity.py); os que expiram depois
+do cálculo são filtrados ao servir. Depois de reprocessar incentivos
+(embeddings/elegibilidade) corre com --all.
+
+    python reverse_match.py            # empresas novas ou re-embedadas
+    python reverse_match.py --all      # recalcula tudo
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from typing import Iterable, List, Optional
+
+import psycopg2
+from dotenv import load_dotenv
+
+import incentive_activity
+
+
+TOP_N = 10          # incentivos guardados por empresa
+CANDIDATES = 50     # vizinhos mais próximos avaliados antes das regras
+BATCH = 1000        # empresas por lote/commit
+
+SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS company_incentives (
+  company_id    bigint PRIMARY KEY,
+  incentive_ids integer[] NOT NULL,
+  scores        real[]    NOT NULL,
+  rule_pass     boolean[] NOT NULL,
+  computed_at   timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+# Mesmas regras e score de match.sql, com o papel de incentivo/empresa trocado.
+# Lê os ids do lote da tabela temporária _reverse_batch.
+REVERSE_SQL = """
+WITH topk AS (
+  SELECT
+    c.id AS cid,
+    i.iid,
+    1 - (i.embedding <=> c.embedding) AS sim,
+    i.eligibility,
+    c.cae_primary_label,
+    lower(regexp_replace(btrim(
+      COALESCE(c.trade_description_native, '') || ' ' ||
+      COALESCE(c.company_name, '')
+    ), '\\s+', ' ', 'g')) AS company_text
+  FROM _reverse_batch b
+  JOIN companies c ON c.id = b.id
+  JOIN LATERAL (
+    SELECT incentive_pk AS iid, embedding, COALESCE(eligibility, '{}'::jsonb) AS eligibility
+    FROM incentives
+    WHERE embedding IS NOT NULL AND is_active
+    ORDER BY embedding <=> c.embedding
+    LIMIT %(candidates)s
+  ) i ON TRUE
+  WHERE c.embedding IS NOT NULL
+),
+rules AS (
+  SELECT
+    t.cid,
+    t.iid,
+    t.sim,
+    (
+      CASE
+        WHEN jsonb_array_length(COALESCE(t.eligibility->'allowed_cae_labels', '[]'::jsonb)) = 0
+          THEN TRUE
+        ELSE EXISTS (
+          SELECT 1
+          FROM jsonb_array_elements_text(t.eligibility->'allowed_cae_labels') lab
+          WHERE lower(regexp_replace(btrim(lab), '\\s+', ' ', 'g'))
+              = lower(regexp_replace(btrim(t.cae_primary_label), '\\s+', ' ', 'g'))
+        )
+      END
+      AND
+      CASE
+        WHEN jsonb_array_length(COALESCE(t.eligibility->'keywords_required', '[]'::jsonb)) = 0
+          THEN TRUE
+        ELSE NOT EXISTS (
+          SELECT 1
+          FROM jsonb_array_elements_text(t.eligibility->'keywords_required') kw
+          WHERE position(lower(regexp_replace(btrim(kw), '\\s+', ' ', 'g')) IN t.company_text) = 0
+        )
+      END
+    ) AS rule_pass,
+    COALESCE((
+      SELECT COUNT(*)
+      FROM jsonb_array_elements_text(COALESCE(t.eligibility->'keywords_bonus', '[]'::jsonb)) kwb
+      WHERE position(lower(regexp_replace(btrim(kwb), '\\s+', ' ', 'g')) IN t.company_text) > 0
+    ), 0) AS bonus_hits
+  FROM topk t
+),
+ranked AS (
+  SELECT
+    r.cid,
+    r.iid,
+    r.rule_pass,
+    (
+      0.70 * r.sim +
+      0.25 * CASE WHEN r.rule_pass THEN 1 ELSE -1 END +
+      0.05 * LEAST(r.bonus_hits, 3)
+    ) AS score,
+    ROW_NUMBER() OVER (
+      PARTITION BY r.cid
+      ORDER BY r.rule_pass DESC,
+               (
+                 0.70 * r.sim +
+                 0.25 * CASE WHEN r.rule_pass THEN 1 ELSE -1 END +
+                 0.05 * LEAST(r.bonus_hits, 3)
+               ) DESC
+    ) AS rnk
+  FROM rules r
+)
+INSERT INTO company_incentives (company_id, incentive_ids, scores, rule_pass, computed_at)
+SELECT b.id,
+       COALESCE(array_agg(r.iid ORDER BY r.rnk) FILTER (WHERE r.iid IS NOT NULL), '{}'),
+       COALESCE(array_agg(r.score::real ORDER BY r.rnk) FILTER (WHERE r.iid IS NOT NULL), '{}'),
+       COALESCE(array_agg(r.rule_pass ORDER BY r.rnk) FILTER (WHERE r.iid IS NOT NULL), '{}'),
+       now()
+FROM _reverse_batch b
+LEFT JOIN ranked r ON r.cid = b.id AND r.rnk <= %(top)s
+GROUP BY b.id
+ON CONFLICT (company_id) DO UPDATE
+SET incentive_ids = EXCLUDED.incentive_ids,
+    scores        = EXCLUDED.scores,
+    rule_pass     = EXCLUDED.rule_pass,
+    computed_at   = EXCLUDED.computed_at
+"""
+
+
+def ensure_schema(cur) -> None:
+    cur.execute(SCHEMA_DDL)
+
+
+def invalidate(cur, company_ids: Iterable[int]) -> None:
+    """Marca empresas para recalcular (ex.: depois de um novo embedding)."""
+
+    cur.execute("DELETE FROM company_incentives WHERE company_id = ANY(%s)", (list(company_ids),))
+
+
+def next_batch(cur, after: int, size: int, refresh_all: bool) -> List[int]:
+    missing = "" if refresh_all else (
+        "AND NOT EXISTS (SELECT 1 FROM company_incentives ci WHERE ci.company_id = c.id)"
+    )
+    cur.execute(
+        f"""
+        SELECT c.id FROM companies c
+        WHERE c.embedding IS NOT NULL AND c.id > %s {missing}
+        ORDER BY c.id
+        LIMIT %s
+        """,
+        (after, size),
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def compute_batch(cur, company_ids: List[int], top: int = TOP_N, candidates: int = CANDIDATES) -> None:
+    cur.execute("SET LOCAL ivfflat.probes = 10")  # como em match.sql; não fica na ligação
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS _reverse_batch (id bigint PRIMARY KEY) ON COMMIT DELETE ROWS")
+    cur.execute("TRUNCATE _reverse_batch")
+    cur.execute("INSERT INTO _reverse_batch (id) SELECT unnest(%s::bigint[])", (company_ids,))
+    cur.execute(REVERSE_SQL, {"top": top, "candidates": candidates})
+
+
+def refresh(conn, refresh_all: bool = False, batch: int = BATCH, top: int = TOP_N) -> int:
+    """Calcula as empresas em falta (ou todas); devolve quantas foram processadas."""
+
+    cur = conn.cursor()
+    ensure_schema(cur)
+    if not incentive_activity.schema_ready(cur):
+        incentive_activity.ensure_schema(cur)
+    conn.commit()
+
+    done, last_id = 0, 0
+    t0 = time.perf_counter()
+    while True:
+        ids = next_batch(cur, last_id, batch, refresh_all)
+        if not ids:
+            break
+        compute_batch(cur, ids, top)
+        conn.commit()
+        done += len(ids)
+        last_id = ids[-1]
+        rate = done / max(time.perf_counter() - t0, 1e-6)
+        print(f"  … {done:,} empresas ({rate:,.0f}/s)", end="\r", flush=True)
+    cur.close()
+    return done
+
+
+def incentives_for_company(cur, company_id: int, limit: int = TOP_N) -> Optional[List[dict]]:
+    """Top incentivos pré-calculados da empresa; None se ainda não foi calculada."""
+
+    # primeiro tira os incentivos que expiraram depois do cálculo, depois limita
+    # e renumera (senão `limit` devolvia menos linhas do que as ativas)
+    cur.execute(
+        """
+        SELECT row_number() OVER (ORDER BY u.ord), u.iid, u.score, u.rule_pass, i.title
+        FROM company_incentives ci
+        CROSS JOIN LATERAL unnest(ci.incentive_ids, ci.scores, ci.rule_pass)
+             WITH ORDINALITY AS u (iid, score, rule_pass, ord)
+        JOIN incentives i ON i.incentive_pk = u.iid
+        WHERE ci.company_id = %s AND i.is_active
+        ORDER BY u.ord
+        LIMIT %s
+        """,
+        (company_id, limit),
+    )
+    rows = cur.fetchall()
+    if not rows:
+        cur.execute("SELECT 1 FROM company_incentives WHERE company_id = %s", (company_id,))
+        if cur.fetchone() is None:
+            return None
+    return [
+        {"rank": r[0], "id": r[1], "score": float(r[2]), "rule_pass": r[3], "title": r[4]}
+        for r in rows
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pré-calcula os top incentivos de cada empresa.")
+    parser.add_argument("--all", action="store_true", help="recalcula todas as empresas")
+    parser.add_argument("--batch", type=int, default=BATCH, help="empresas por lote/commit")
+    parser.add_argument("--top", type=int, default=TOP_N, help="incentivos guardados por empresa")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise SystemExit("DATABASE_URL não definido")
+
+    t0 = time.perf_counter()
+    conn = psycopg2.connect(db_url)
+    try:
+        done = refresh(conn, args.all, args.batch, args.top)
+    finally:
+        conn.close()
+    print(f"✅ {done:,} empresas com top incentivos atualizados em {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,80 @@
 import os
+import argparse
 import psycopg2
 from dotenv import load_dotenv
+import matches_store
+import incentive_activity
+import profiling
 
 load_dotenv()
 SQL_PATH = "match.sql"
 DB_URL = os.getenv("DATABASE_URL")
 
-if not DB_URL:
-    raise SystemExit("DATABASE_URL não definido no .env")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Executa match.sql numa geração nova de matches.")
+    parser.add_argument("--publish", action="store_true",
+                        help="publica logo a geração (sem esperar pelas explicações)")
+    parser.add_argument("--include-inactive", action="store_true",
+                        help="inclui incentivos fechados/expirados no matching")
+    return parser.parse_args(argv)
 
-if not os.path.exists(SQL_PATH):
-    raise SystemExit(f"Ficheiro {SQL_PATH} não encontrado")
+def main(args=None, conn=None):
+    """Corre match.sql numa geração nova e devolve o nº da geração.
 
-with open(SQL_PATH, encoding="utf-8") as fh:
-    sql = fh.read()
+    `conn` permite reutilizar uma ligação (ex.: pipeline.py); sem ela abre e fecha uma.
+    """
+    args = args or parse_args([])
+    if not os.path.exists(SQL_PATH):
+        raise SystemExit(f"Ficheiro {SQL_PATH} não encontrado")
 
-conn = psycopg2.connect(DB_URL)
-cur = conn.cursor()
-cur.execute(sql)
-conn.commit()
-cur.close()
-conn.close()
+    with open(SQL_PATH, encoding="utf-8") as fh:
+        sql = fh.read()
 
-print("✅ match.sql executado com sucesso")
+    own_conn = conn is None
+    if own_conn:
+        if not DB_URL:
+            raise SystemExit("DATABASE_URL não definido no .env")
+        conn = psycopg2.connect(DB_URL)
+    cur = conn.cursor()
+    try:
+        with profiling.span("setup"):
+            matches_store.ensure_schema(cur)
+            if not incentive_activity.schema_ready(cur):
+                incentive_activity.ensure_schema(cur)
+            incentive_activity.refresh(cur)  # datas podem ter passado desde o último cron
+            generation = matches_store.new_generation(cur, "run_match.py")
+            conn.commit()
+
+        # match.sql lê a geração de destino destes parâmetros; locais à transação
+        # para não ficarem na ligação (o pipeline.py devolve-a a um pool partilhado)
+        cur.execute("SELECT set_config('pipeline.generation', %s, true)", (str(generation),))
+        cur.execute("SELECT set_config('pipeline.include_inactive', %s, true)",
+                    ("on" if args.include_inactive else "off",))
+        try:
+            profiling.execute(cur, sql, label="match.sql")
+            with profiling.span("commit"):
+                matches_store.mark_complete(cur, generation)
+                if args.publish:
+                    matches_store.publish(cur, generation)
+                conn.commit()
+        except BaseException:
+            # não deixar a geração em 'building' para sempre
+            try:
+                conn.rollback()
+                matches_store.mark_failed(cur, generation)
+                conn.commit()
+            except psycopg2.Error:
+                pass  # ligação perdida: o erro original é o que interessa
+            raise
+    finally:
+        cur.close()
+        if own_conn:
+            conn.close()
+
+    print(f"✅ match.sql executado com sucesso (geração {generation}"
+          f"{', publicada' if args.publish else ', por publicar — corre explain_matches.py'})")
+    return generation
+
+if __name__ == "__main__":
+    profiling.init("run_match")  # --profile / PIPELINE_PROFILE
+    main(parse_args())
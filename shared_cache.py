@@ -0,0 +1,150 @@
+"""Cache partilhada entre workers da API.
+
+O backend escolhe-se com `CACHE_URL`:
+
+- `memory://`              → dicionário LRU em memória (um só worker; default;
+                              `CACHE_MAX_ENTRIES`, 10000 por omissão)
+- `sqlite:///caminho.db`   → ficheiro SQLite em WAL, partilhado pelos workers do host
+- `redis://host:6379/0`    → servidor Redis (ou compatível); requer o pacote `redis`
+
+Os valores são serializados em JSON; todas as operações são síncronas e
+curtas, por isso na API correm no threadpool junto com as queries.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class MemoryCache:
+    """Dicionário LRU com limite de entradas: as chaves incluem texto do
+    cliente (perguntas, `cae=`), por isso sem limite a memória cresce à vontade."""
+
+    def __init__(self, max_entries: int = 10_000) -> None:
+        self.max_entries = max_entries
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._sets = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            if hit[1] <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+        return json.loads(hit[0])
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        raw = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._data[key] = (raw, now + ttl)
+            self._data.move_to_end(key)
+            # limpeza oportunista das entradas expiradas, como no SQLiteCache
+            self._sets += 1
+            if self._sets % 500 == 0:
+                for k in [k for k, (_, expires) in self._data.items() if expires <= now]:
+                    del self._data[k]
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SQLiteCache:
+    """Cache num ficheiro SQLite local: serve vários processos no mesmo host."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()  # uma ligação por thread, aberta só quando usada
+        self._sets = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._local.db = db
+        return db
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        now = time.time()
+        db = self._conn()
+        db.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now + ttl),
+        )
+        # limpeza oportunista das entradas expiradas
+        self._sets += 1
+        if self._sets % 500 == 0:
+            db.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+
+    def delete(self, key: str) -> None:
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class RedisCache:
+    """Backend Redis; `client` permite injetar um substituto local (ex.: fakeredis)."""
+
+    def __init__(self, url: Optional[str] = None, client: Any = None) -> None:
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("CACHE_URL=redis://… requer `pip install redis`") from e
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def get(self, key: str) -> Optional[Any]:
+        raw = self.client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self.client.set(key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000))
+
+    def delete(self, key: str) -> None:
+        self.client.delete(key)
+
+
+def cache_from_url(url: Optional[str] = None):
+    url = url or os.getenv("CACHE_URL", "memory://")
+    if url.startswith("memory://"):
+        return MemoryCache(int(os.getenv("CACHE_MAX_ENTRIES", "10000")))
+    if url.startswith("sqlite:///"):
+        return SQLiteCache(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url)
+    raise ValueError(f"CACHE_URL não suportado: {url}")
+
+
+def worker_count() -> int:
+    """Nº de workers do host (WEB_CONCURRENCY, usado por uvicorn/gunicorn)."""
+
+    try:
+        return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        return 1
+
+
+__all__ = ["MemoryCache", "SQLiteCache", "RedisCache", "cache_from_url", "worker_count"]
@@ -0,0 +1,205 @@
+"""Coalescência de pedidos idênticos em curso (single-flight) para a API.
+
+- `SingleFlight`: vários pedidos com a mesma chave partilham uma só execução.
+- `StreamFanout`: uma stream upstream (ex.: resposta da OpenAI) distribuída
+  por vários clientes; quem chega a meio recebe primeiro o que já foi gerado.
+
+Ambos vivem no event loop (um por worker) e só coalescem pedidos em curso:
+quando a execução termina a chave é libertada.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+class SingleFlight:
+    """Partilha o resultado de uma coroutine entre pedidos concorrentes."""
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f, key=key: self._forget(key, f))
+        # shield: um cliente que desiste não cancela o trabalho dos outros
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: Hashable, fut: asyncio.Future) -> None:
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+
+
+class StreamAborted(RuntimeError):
+    """O subscritor ficou demasiado para trás (ou a stream foi abortada)."""
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.chunks: List[str] = []
+        self.done = False
+        self.aborted = False
+        self.joined = False
+        self.positions: Dict[int, int] = {}  # subscritor → nº de chunks já lidos
+        self.task: Optional[asyncio.Task] = None
+        self.wakeup = asyncio.Event()    # novos chunks / fim (acorda os leitores)
+        self.progress = asyncio.Event()  # um leitor avançou (acorda o produtor)
+
+    def notify(self) -> None:
+        event, self.wakeup = self.wakeup, asyncio.Event()
+        event.set()
+
+    def notify_progress(self) -> None:
+        event, self.progress = self.progress, asyncio.Event()
+        event.set()
+
+
+class StreamFanout:
+    """Uma stream upstream por chave, com N subscritores.
+
+    Backpressure: o upstream só avança enquanto o leitor mais lento estiver
+    a ≤ `max_lag` chunks; quem não recuperar em `lag_timeout` segundos é
+    desligado (StreamAborted) para não travar os restantes. `max_chunks` é um
+    teto de segurança para o histórico (a resposta já é limitada por
+    `max_output_tokens`). Quando o último subscritor sai antes do fim — ou
+    ninguém chega a ler em `join_timeout` segundos — a stream upstream é
+    cancelada.
+    """
+
+    def __init__(
+        self,
+        max_lag: int = 64,
+        lag_timeout: float = 30.0,
+        max_chunks: int = 4096,
+        join_timeout: float = 10.0,
+    ) -> None:
+        self.max_lag = max_lag
+        self.lag_timeout = lag_timeout
+        self.max_chunks = max_chunks
+        self.join_timeout = join_timeout
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._ids = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    def start(
+        self,
+        key: Hashable,
+        make_stream: Callable[[], AsyncIterator[str]],
+        on_done: Optional[Callable[[], None]] = None,
+    ) -> bool:
+        """Arranca a stream upstream se ainda não existir; True se foi criada agora.
+
+        `on_done` corre sempre que a stream termina (incluindo cancelamento).
+        """
+        if key in self._flights:
+            return False
+        flight = _Flight()
+        self._flights[key] = flight
+        flight.task = asyncio.ensure_future(self._run(key, flight, make_stream))
+        if on_done is not None:
+            flight.task.add_done_callback(lambda _task: on_done())
+        asyncio.get_running_loop().call_later(
+            self.join_timeout, self._check_joined, key, flight
+        )
+        return True
+
+    def subscribe(
+        self, key: Hashable, make_stream: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """Devolve o iterador dos deltas; o subscritor só conta quando começa a ler."""
+        self.start(key, make_stream)
+        return self._iterate(key, self._flights[key])
+
+    async def _iterate(self, key: Hashable, flight: _Flight) -> AsyncIterator[str]:
+        if flight.aborted:
+            raise StreamAborted("stream upstream abortada")
+        sid = next(self._ids)
+        flight.positions[sid] = 0
+        flight.joined = True
+        try:
+            while True:
+                wakeup = flight.wakeup
+                pos = flight.positions.get(sid)
+                if pos is None:
+                    raise StreamAborted("subscritor demasiado lento")
+                if pos < len(flight.chunks):
+                    flight.positions[sid] = pos + 1
+                    flight.notify_progress()
+                    yield flight.chunks[pos]
+                    continue
+                if flight.done:
+                    if flight.aborted:
+                        raise StreamAborted("stream upstream abortada")
+                    break
+                await wakeup.wait()
+        finally:
+            flight.positions.pop(sid, None)
+            flight.notify_progress()
+            if not flight.positions and not flight.done:
+                # ninguém está a ouvir → aborta upstream e liberta a chave
+                self._abort(key, flight)
+
+    async def _run(self, key: Hashable, flight: _Flight, make_stream) -> None:
+        try:
+            async for chunk in make_stream():
+                flight.chunks.append(chunk)
+                flight.notify()
+                if len(flight.chunks) >= self.max_chunks:
+                    break
+                if not await self._backpressure(flight):
+                    flight.aborted = True
+                    break
+        finally:
+            flight.done = True
+            flight.notify()
+            self._forget(key, flight)
+
+    async def _backpressure(self, flight: _Flight) -> bool:
+        """Espera pelos leitores atrasados; False se todos tiverem sido desligados."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lag_timeout
+        while True:
+            limit = len(flight.chunks) - self.max_lag
+            slow = [sid for sid, pos in flight.positions.items() if pos < limit]
+            if not slow:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                for sid in slow:
+                    del flight.positions[sid]
+                return bool(flight.positions)
+            progress = flight.progress
+            try:
+                await asyncio.wait_for(progress.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def _check_joined(self, key: Hashable, flight: _Flight) -> None:
+        # subscribe() sem leitura (ex.: cliente desligou antes do corpo) não prende o upstream
+        if not flight.joined and not flight.done:
+            self._abort(key, flight)
+
+    def _abort(self, key: Hashable, flight: _Flight) -> None:
+        flight.aborted = True
+        flight.task.cancel()
+        self._forget(key, flight)
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
+__all__ = ["SingleFlight", "StreamAborted", "StreamFanout"]